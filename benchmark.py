@@ -0,0 +1,301 @@
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from functools import partial
+from itertools import islice
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from data_utils import stream_data, DocumentDataset, BucketBatchSampler, make_loader
+from profiling import peak_rss_mb
+
+
+# A benchmark run trains and scores both models on every combination of the swept settings and writes
+# one record per combination to <output>.json (with the run's metadata) and <output>.csv:
+#   model, corpus, hidden_dim, batch_size, vocab_size, seq_len, threads = The configuration (KEY)
+#   documents, tokens, mean_length = The corpus as measured
+#   parameters = The number of model parameters
+#   train_examples_per_sec, train_tokens_per_sec, train_p50_ms, train_p90_ms, train_p99_ms
+#     = Training throughput and per-step latency (fetch, forward, loss, backward, optimizer step)
+#   infer_docs_per_sec, infer_p50_ms, infer_p90_ms, infer_p99_ms
+#     = Inference throughput and per-minibatch latency (collate and forward pass under inference_mode)
+#   peak_rss_mb = The peak resident memory of the configuration
+# Every configuration runs in a fresh process, so that peak_rss_mb and the thread count belong to it alone.
+KEY = ["model", "corpus", "hidden_dim", "batch_size", "vocab_size", "seq_len", "threads"]
+# metric: True if higher is better
+METRICS = {"train_examples_per_sec": True, "train_p99_ms": False,
+           "infer_docs_per_sec": True, "infer_p99_ms": False, "peak_rss_mb": False}
+SYNTHETIC = "synthetic"
+EMBEDDING_DIM = 50
+
+
+# Raised by run_config for a configuration that cannot be timed because its batch size leaves no
+# training minibatch; the run skips it and goes on, while every other error ends the run.
+class NoMinibatchesError(ValueError):
+    pass
+
+
+# Returns:
+# ids, offsets, labels = num_documents synthetic documents in the flatten_documents layout. Lengths are
+#                        uniform in [seq_len / 2, 3 * seq_len / 2] and words follow a Zipf distribution
+#                        over vocab_size ids, so that the corpus looks like text to both models.
+def synthetic_corpus(num_documents, vocab_size, seq_len, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(max(1, seq_len // 2), seq_len * 3 // 2 + 1, size=num_documents)
+    frequencies = 1.0 / np.arange(1, vocab_size + 1)
+    ids = rng.choice(vocab_size, size=int(lengths.sum()), p=frequencies / frequencies.sum()).astype(np.int32)
+    offsets = np.zeros(num_documents + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    labels = rng.integers(0, 5, size=num_documents).astype(np.int64)
+    return ids, offsets, labels
+
+
+# Returns:
+# vocab_size = The size of the vocabulary of the first num_documents documents of data_path
+# ids, offsets, labels = Those documents vectorized against it as ffnn.py does. Both models read the
+#                        same ids; the RNN looks them up in a random embedding, which costs the same
+#                        as a pretrained one.
+def file_corpus(data_path, num_documents):
+    from ffnn import make_vocab, make_indices, convert_to_ids
+    documents = list(islice(stream_data(data_path), num_documents))
+    word2index, _ = make_indices(make_vocab(documents))
+    return len(word2index), convert_to_ids(documents, word2index)
+
+
+# Returns:
+# p50, p90, p99 = Percentiles of the durations (seconds) in milliseconds
+def percentiles_ms(durations):
+    return [float(p) for p in np.percentile(np.array(durations) * 1000, [50, 90, 99])]
+
+
+# Returns:
+# batches = An endless iterator over the minibatches of loader, epoch after epoch
+def cycle(loader):
+    if len(loader) == 0:
+        raise ValueError("the loader has no minibatches to cycle over")
+    while True:
+        yield from loader
+
+
+# Trains and scores one model on one configuration (a dict with the KEY fields and the run options).
+# Returns:
+# record = The configuration with its measurements (see KEY)
+def run_config(config):
+    random.seed(config["seed"])
+    np.random.seed(config["seed"])
+    torch.manual_seed(config["seed"])
+    torch.set_num_threads(config["threads"])
+
+    if config["corpus"] == SYNTHETIC:
+        vocab_size = config["vocab_size"]
+        ids, offsets, labels = synthetic_corpus(config["documents"], vocab_size, config["seq_len"], config["seed"])
+    else:
+        vocab_size, (ids, offsets, labels) = file_corpus(config["corpus"], config["documents"])
+    dataset = DocumentDataset(ids, offsets, labels)
+    lengths = np.diff(offsets)
+
+    if config["model"] == "ffnn":
+        from ffnn import FFNN, collate_bag_of_words
+        model = FFNN(input_dim = vocab_size, h = config["hidden_dim"])
+        optimizer = optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+        collate_fn = partial(collate_bag_of_words, vocab_size=vocab_size)
+        train_loader = make_loader(dataset, collate_fn, batch_size=config["batch_size"], shuffle=True, drop_last=True)
+        infer_loader = make_loader(dataset, collate_fn, batch_size=config["batch_size"])
+    else:
+        from rnn import RNN, collate_padded
+        model = RNN(EMBEDDING_DIM, config["hidden_dim"], torch.randn(vocab_size, EMBEDDING_DIM))
+        optimizer = optim.Adam(model.parameters(), lr=0.01)
+        collate_fn = collate_padded
+        train_loader = make_loader(dataset, collate_fn,
+                                   batch_sampler=BucketBatchSampler(lengths.tolist(), config["batch_size"]))
+        # the inference minibatches are bucketed too, but in a seeded random order: unshuffled they go from
+        # the shortest documents to the longest, and the timed steps would only see the shortest ones
+        infer_loader = make_loader(dataset, collate_fn,
+                                   batch_sampler=BucketBatchSampler(lengths.tolist(), config["batch_size"],
+                                                                    rng=random.Random(config["seed"])))
+
+    if len(train_loader) == 0:
+        raise NoMinibatchesError("batch size {} is larger than the {} documents of {}".format(
+            config["batch_size"], len(dataset), config["corpus"]))
+
+    # the first warmup steps (allocator and thread pool start-up) are not timed
+    model.train()
+    step_times = []
+    examples = 0
+    tokens = 0
+    batches = cycle(train_loader)
+    for step in range(config["warmup"] + config["steps"]):
+        start = time.perf_counter()
+        indices, inputs, gold_labels = next(batches)
+        optimizer.zero_grad()
+        loss = model.compute_Loss(model(inputs), gold_labels)
+        loss.backward()
+        optimizer.step()
+        if step >= config["warmup"]:
+            step_times.append(time.perf_counter() - start)
+            examples += len(indices)
+            tokens += int(lengths[indices.numpy()].sum())
+
+    model.eval()
+    batch_times = []
+    scored = 0
+    batches = cycle(infer_loader)
+    with torch.inference_mode():
+        for step in range(config["warmup"] + config["steps"]):
+            start = time.perf_counter()
+            indices, inputs, _ = next(batches)
+            model(inputs)
+            if step >= config["warmup"]:
+                batch_times.append(time.perf_counter() - start)
+                scored += len(indices)
+
+    record = {key: config[key] for key in KEY}
+    if config["corpus"] != SYNTHETIC:
+        # a data file fixes its own vocabulary and lengths
+        record["vocab_size"] = vocab_size
+    record.update({"documents": len(dataset), "tokens": len(ids), "mean_length": len(ids) / len(dataset),
+                   "parameters": sum(parameter.numel() for parameter in model.parameters())})
+    train_p50, train_p90, train_p99 = percentiles_ms(step_times)
+    record.update({"train_examples_per_sec": examples / sum(step_times),
+                   "train_tokens_per_sec": tokens / sum(step_times),
+                   "train_p50_ms": train_p50, "train_p90_ms": train_p90, "train_p99_ms": train_p99})
+    infer_p50, infer_p90, infer_p99 = percentiles_ms(batch_times)
+    record.update({"infer_docs_per_sec": scored / sum(batch_times),
+                   "infer_p50_ms": infer_p50, "infer_p90_ms": infer_p90, "infer_p99_ms": infer_p99,
+                   "peak_rss_mb": peak_rss_mb()})
+    return record
+
+
+# Returns:
+# configs = One configuration per combination of the swept settings. vocab_size and seq_len only apply
+#           to the synthetic corpus; a data file is run once per combination of the other settings.
+def make_configs(args):
+    configs = []
+    for corpus in args.corpora:
+        vocab_sizes = args.vocab_size if corpus == SYNTHETIC else [None]
+        seq_lens = args.seq_len if corpus == SYNTHETIC else [None]
+        for model, hidden_dim, batch_size, vocab_size, seq_len, threads in itertools.product(
+                args.models, args.hidden_dim, args.batch_size, vocab_sizes, seq_lens, args.threads):
+            configs.append({"model": model, "corpus": corpus, "hidden_dim": hidden_dim, "batch_size": batch_size,
+                            "vocab_size": vocab_size, "seq_len": seq_len, "threads": threads,
+                            "documents": args.documents, "steps": args.steps, "warmup": args.warmup,
+                            "seed": args.seed})
+    return configs
+
+
+# Returns:
+# metadata = What the numbers of a run depend on besides its configurations
+def run_metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "python": platform.python_version(),
+            "torch": torch.__version__, "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(), "args": vars(args)}
+
+
+def write_results(path, metadata, records):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"metadata": metadata, "results": records}, f, indent=2)
+    if records:
+        with open(os.path.splitext(path)[0] + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(records[0]))
+            writer.writeheader()
+            writer.writerows(records)
+
+
+# Compares records with the records of a baseline run, configuration by configuration.
+# Returns:
+# regressions = A list of (configuration, metric, baseline value, new value) for every METRICS value
+#               that got worse by more than tolerance (a fraction of the baseline value), and of
+#               (configuration, None, None, None) for every baseline configuration that has no record
+#               in this run (it failed or was skipped)
+def compare_results(baseline_records, records, tolerance):
+    baseline = {tuple(record[key] for key in KEY): record for record in baseline_records}
+    measured = {tuple(record[key] for key in KEY) for record in records}
+    regressions = [({key: old[key] for key in KEY}, None, None, None)
+                   for config, old in baseline.items() if config not in measured]
+    for record in records:
+        old = baseline.get(tuple(record[key] for key in KEY))
+        if old is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            change = (record[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(({key: record[key] for key in KEY}, metric, old[metric], record[metric]))
+    return regressions
+
+
+def print_record(record):
+    print("{model} {corpus} hd={hidden_dim} b={batch_size} V={vocab_size} L={seq_len} threads={threads}: "
+          "train {train_examples_per_sec:.1f} ex/s (p50 {train_p50_ms:.2f} / p99 {train_p99_ms:.2f} ms), "
+          "infer {infer_docs_per_sec:.1f} docs/s (p50 {infer_p50_ms:.2f} / p99 {infer_p99_ms:.2f} ms), "
+          "peak RSS {peak_rss_mb:.1f} MB".format(**record))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--models", nargs="+", choices = ["ffnn", "rnn"], default = ["ffnn", "rnn"], help = "models to run")
+    parser.add_argument("--corpora", nargs="+", default = [SYNTHETIC],
+                        help = "'synthetic' and/or data files (e.g. validation.json test.json) to take documents from")
+    parser.add_argument("--documents", type=int, default = 2000, help = "documents per corpus")
+    parser.add_argument("-hd", "--hidden_dim", type=int, nargs="+", default = [32], help = "hidden_dim values")
+    parser.add_argument("-b", "--batch_size", type=int, nargs="+", default = [16, 256], help = "minibatch sizes")
+    parser.add_argument("--vocab_size", type=int, nargs="+", default = [10000], help = "synthetic vocabulary sizes")
+    parser.add_argument("--seq_len", type=int, nargs="+", default = [100], help = "synthetic mean document lengths")
+    parser.add_argument("--threads", type=int, nargs="+", default = [1], help = "torch intra-op thread counts")
+    parser.add_argument("--steps", type=int, default = 50, help = "timed training steps and inference minibatches")
+    parser.add_argument("--warmup", type=int, default = 5, help = "untimed steps before the timed ones")
+    parser.add_argument("--seed", type=int, default = 42, help = "seed of the corpora, models and shuffling")
+    parser.add_argument("--output", default = None,
+                        help = "results file (default: results/benchmarks/<time>.json, with a .csv next to it)")
+    parser.add_argument("--baseline", default = None, help = "results file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default = 0.1,
+                        help = "relative slowdown or memory growth over the baseline flagged as a regression")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join("results", "benchmarks", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    metadata = run_metadata(args)
+    configs = make_configs(args)
+    records = []
+    context = multiprocessing.get_context("spawn")
+    for number, config in enumerate(configs):
+        print("========== Benchmark {}/{} ==========".format(number + 1, len(configs)))
+        with context.Pool(1) as pool:
+            try:
+                record = pool.apply(run_config, (config,))
+            except NoMinibatchesError as error:
+                print("Skipped: {}".format(error))
+                continue
+        print_record(record)
+        records.append(record)
+    write_results(output, metadata, records)
+    print("Results written to {}".format(output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_results(json.load(f)["results"], records, args.tolerance)
+        for config, metric, old, new in regressions:
+            name = " ".join("{}={}".format(key, value) for key, value in config.items())
+            if metric is None:
+                print("REGRESSION {}: missing from this run".format(name))
+            else:
+                print("REGRESSION {}: {} {:.2f} -> {:.2f}".format(name, metric, old, new))
+        print("{} regression(s) against {} (tolerance {:.0%})".format(len(regressions), args.baseline, args.tolerance))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,186 @@
+import os
+import random
+from functools import partial
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from data_utils import BucketBatchSampler, make_loader, load_words
+from preprocess import VOCAB_FILE
+
+
+# A saved model is a dict written with torch.save:
+#   model      = "ffnn" or "rnn"
+#   config     = The constructor arguments needed to rebuild the model
+#                ffnn: input_dim, hidden_dim, hash_buckets (None with a vocabulary), bigrams;
+#                rnn: hidden_dim, embedding (directory), vocab_digest (of the embedding), fine_tune_embedding
+#   vocab      = The FFNN vocabulary (index2word as a list); None for hashed FFNN features and for
+#                the RNN, whose vocabulary is the one of its embedding directory
+#   state_dict = The parameters. A frozen RNN embedding is left out: it is read back from the
+#                embedding directory instead of being copied into every file.
+# A training checkpoint (save_checkpoint) is a saved model with the training state added:
+#   optimizer  = The optimizer state_dict
+#   epoch      = The number of epochs completed
+#   rng        = The python, numpy and torch random states
+#   history    = A dict of whatever the training script needs to carry on (per-epoch metrics, ...)
+# so load_model and predict.py read checkpoints as well.
+def model_state(model_name, model, config, vocab=None):
+    state_dict = model.state_dict()
+    if model_name == "rnn" and not config["fine_tune_embedding"]:
+        state_dict.pop("embedding.weight")
+    return {"model": model_name, "config": config, "vocab": vocab, "state_dict": state_dict}
+
+
+# Writes state to path through a temporary file, so that a run killed while saving keeps the
+# previous file intact
+def write_state(path, state):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_model(path, model_name, model, config, vocab=None):
+    write_state(path, model_state(model_name, model, config, vocab))
+
+
+def save_checkpoint(path, model_name, model, config, vocab, optimizer, epoch, history):
+    state = model_state(model_name, model, config, vocab)
+    state["optimizer"] = optimizer.state_dict()
+    state["epoch"] = epoch
+    state["rng"] = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    state["history"] = history
+    write_state(path, state)
+
+
+def load_state_dict(model, state_dict, path):
+    # a frozen embedding is not in the file; everything else must match exactly
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if unexpected or set(missing) - {"embedding.weight"}:
+        raise ValueError("{}: state_dict does not match the model (missing {}, unexpected {})".format(
+            path, missing, unexpected))
+
+
+# Returns:
+# model = The model saved at path, rebuilt and in eval mode
+# checkpoint = The saved dict (see model_state)
+def load_model(path):
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    config = checkpoint["config"]
+    if checkpoint["model"] == "ffnn":
+        from ffnn import FFNN
+        model = FFNN(input_dim = config["input_dim"], h = config["hidden_dim"])
+    else:
+        from rnn import RNN
+        from embedding import load_matrix, check_vocab
+        check_vocab(config["embedding"], config.get("vocab_digest"), path)
+        embedding_matrix = load_matrix(config["embedding"], fine_tune=config["fine_tune_embedding"])
+        model = RNN(embedding_matrix.shape[1], config["hidden_dim"], embedding_matrix,
+                    fine_tune=config["fine_tune_embedding"])
+    load_state_dict(model, checkpoint["state_dict"], path)
+    model.eval()
+    return model, checkpoint
+
+
+# Returns:
+# model = A fresh model for the dataset of args.data_dir
+# collate_fn = The collate function of the model
+# model_config, vocab = What save_model needs to write the model
+def build_model(args, meta):
+    if args.model == "ffnn":
+        from ffnn import FFNN, collate_bag_of_words
+        vocab = None
+        if meta.get("hash_buckets") is not None:
+            input_dim = meta["hash_buckets"]
+        else:
+            vocab = load_words(os.path.join(args.data_dir, VOCAB_FILE))
+            input_dim = len(vocab)
+        model = FFNN(input_dim = input_dim, h = args.hidden_dim)
+        model_config = {"input_dim": input_dim, "hidden_dim": args.hidden_dim,
+                        "hash_buckets": meta.get("hash_buckets"), "bigrams": meta.get("bigrams", False)}
+        return model, partial(collate_bag_of_words, vocab_size=input_dim), model_config, vocab
+    from rnn import RNN, collate_padded
+    from embedding import load_matrix, check_vocab
+    check_vocab(meta["embedding"], meta.get("vocab_digest"), args.data_dir)
+    embedding_matrix = load_matrix(meta["embedding"], fine_tune=args.fine_tune_embedding)
+    model = RNN(embedding_matrix.shape[1], args.hidden_dim, embedding_matrix, fine_tune=args.fine_tune_embedding)
+    model_config = {"hidden_dim": args.hidden_dim, "embedding": meta["embedding"],
+                    "vocab_digest": meta["vocab_digest"], "fine_tune_embedding": args.fine_tune_embedding}
+    return model, collate_padded, model_config, None
+
+
+# Returns:
+# optimizer = An optimizer over the parameters of model: "sgd" (with momentum, as in ffnn.py)
+#             or "adam" (as in rnn.py); by default the one of the model's own training script
+def make_optimizer(model_name, model, name=None, lr=0.01):
+    name = name or ("sgd" if model_name == "ffnn" else "adam")
+    if name == "sgd":
+        return optim.SGD(model.parameters(), lr=lr, momentum=0.9)
+    return optim.Adam(model.parameters(), lr=lr)
+
+
+# Returns:
+# train_loader = The training minibatches of train_dataset for model_name, from a sampler seeded with seed
+#                that drops the last short minibatch: length-bucketed for the RNN, a plain shuffle for the
+#                FFNN, which reads bags of words (bucket width 0). With num_replicas, the rank-th shard.
+def make_train_loader(model_name, train_dataset, collate_fn, batch_size, bucket_width, seed,
+                      num_replicas=1, rank=0):
+    train_sampler = BucketBatchSampler(train_dataset.lengths(), batch_size,
+                                       bucket_width if model_name == "rnn" else 0, drop_last=True,
+                                       rng=random.Random(seed), num_replicas=num_replicas, rank=rank)
+    return make_loader(train_dataset, collate_fn, batch_sampler=train_sampler)
+
+
+# Trains model for one pass over train_loader. The minibatches go through forward, by default the model
+# itself (or e.g. its DistributedDataParallel wrapper).
+# Returns:
+# correct, total = The number of correctly predicted and of all training documents
+def train_epoch(model, optimizer, train_loader, forward=None):
+    forward = forward or model
+    forward.train()
+    correct = 0
+    total = 0
+    for _, inputs, gold_labels in train_loader:
+        optimizer.zero_grad()
+        output = forward(inputs)
+        loss = model.compute_Loss(output, gold_labels)
+        loss.backward()
+        optimizer.step()
+        correct += int((torch.argmax(output, dim=1) == gold_labels).sum())
+        total += len(gold_labels)
+    return correct, total
+
+
+# Loads only the parameters saved at path into an already built model
+def load_weights(path, model):
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    load_state_dict(model, checkpoint["state_dict"], path)
+
+
+# Restores the model, optimizer and random states saved by save_checkpoint into an already built
+# model and optimizer. The checkpoint must have been saved with config and vocab: this is checked
+# before any weight is copied, since a model built otherwise may hold a read-only memory-mapped
+# embedding, or a vocabulary the saved rows do not belong to.
+# Returns:
+# checkpoint = The saved dict, for its epoch and history
+def load_checkpoint(path, model, optimizer, config, vocab=None):
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if checkpoint["config"] != config or checkpoint["vocab"] != vocab:
+        raise ValueError("{} was trained with a different vocabulary or model".format(path))
+    load_state_dict(model, checkpoint["state_dict"], path)
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    random.setstate(checkpoint["rng"]["python"])
+    np.random.set_state(checkpoint["rng"]["numpy"])
+    torch.set_rng_state(checkpoint["rng"]["torch"])
+    return checkpoint
+
+
+# Adds the checkpointing options to an ArgumentParser
+def add_checkpoint_arguments(parser, model_name):
+    parser.add_argument("--checkpoint_dir", default = "checkpoints/" + model_name,
+                        help = "directory for last.pt (periodic) and best.pt (best validation accuracy)")
+    parser.add_argument("--checkpoint_every", type=int, default = 1, help = "save last.pt every N epochs (0 = never)")
+    parser.add_argument("--resume", action='store_true', help = "continue from last.pt in --checkpoint_dir")
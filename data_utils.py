@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+from array import array
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler, BatchSampler, RandomSampler
+
+
+# Yields the records of a JSON file one at a time, reading it in chunks of chunk_size characters.
+# The file is either one JSON array of records (training.json, validation.json, test.json) or
+# JSON Lines with one record per line; the format is detected from the first non-whitespace character.
+# Only the record being decoded is ever held in memory, never the whole file.
+def iter_json_records(path, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = ""
+        eof = False
+        # the format is told by the first character that is not whitespace, however many chunks away
+        while not eof and not buffer.strip():
+            chunk = f.read(chunk_size)
+            eof = len(chunk) < chunk_size
+            buffer = buffer.lstrip() + chunk
+        pos = len(buffer) - len(buffer.lstrip())
+        in_array = buffer[pos:pos + 1] == "["
+        if in_array:
+            pos += 1
+        while True:
+            # skip the separators between records
+            while pos < len(buffer) and (buffer[pos].isspace() or (in_array and buffer[pos] == ",")):
+                pos += 1
+            if in_array and buffer[pos:pos + 1] == "]":
+                return
+            if pos == len(buffer) and eof:
+                if in_array:
+                    raise ValueError("{}: unterminated JSON array".format(path))
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+                # a record cut by the buffer end (e.g. the number 12 of 123) may continue in the next chunk;
+                # it is only complete once it is followed by a separator or ends with a closing character
+                complete = eof or (end < len(buffer) and (buffer[end - 1] in '}]"' or buffer[end] in " \t\r\n,]"))
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                chunk = f.read(chunk_size)
+                eof = len(chunk) < chunk_size
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield record
+            pos = end
+            if pos > chunk_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+# Yields:
+# (document, y) pairs read lazily from a data file; document is the list of whitespace-separated
+# words of the review text and y in {0,1,2,3,4} is its number of stars minus one (-1 when the
+# record has no stars, e.g. in a file that is only scored)
+def stream_data(path):
+    for elt in iter_json_records(path):
+        yield elt["text"].split(), int(elt["stars"]-1) if "stars" in elt else -1
+
+
+# Returns:
+# texts = A dict with the text of each document index in indices (its words joined by single spaces,
+#         as stream_data splits them), found in one pass over the data file that stops at the last of them;
+#         empty when there is no such file (path None, or the file is gone), or when digest is given and
+#         the file no longer has that file_digest: its document i may then be another review
+def read_texts(path, indices, digest=None):
+    wanted = set(indices)
+    texts = {}
+    if path is None or not os.path.isfile(path):
+        return texts
+    if digest is not None and file_digest(path) != digest:
+        return texts
+    for index, (document, _) in enumerate(stream_data(path)):
+        if len(texts) == len(wanted):
+            break
+        if index in wanted:
+            texts[index] = " ".join(document)
+    return texts
+
+
+# Flattens documents, an iterable of (ids of the words of a document, y) pairs, into the binary
+# dataset layout shared by both models.
+# Returns:
+# ids = A flat int32 array with the ids of every word of every document
+# offsets = An int64 array of length N + 1; document i is ids[offsets[i]:offsets[i + 1]]
+# labels = An int64 array with the N labels
+def flatten_documents(documents):
+    ids = array("i")
+    offsets = array("q", [0])
+    labels = array("q")
+    for document_ids, y in documents:
+        ids.extend(document_ids)
+        offsets.append(len(ids))
+        labels.append(y)
+    return (np.frombuffer(ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64),
+            np.frombuffer(labels, dtype=np.int64))
+
+
+# Writes words to path, one per line; the line number is the id of the word
+def save_words(path, words):
+    with open(path, "w", encoding="utf-8") as f:
+        for word in words:
+            f.write(word + "\n")
+
+
+# Returns:
+# words = A list with the words saved by save_words, indexed by id
+def load_words(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read().split("\n")[:-1]
+
+
+# Returns:
+# digest = The hex SHA-1 of the file content, read in chunks so large files are never held in memory
+def file_digest(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Writes each array to <directory>/<name>.npy. The arrays are written to a temporary directory
+# that is renamed into place at the end, so an interrupted run never leaves a half-written cache.
+def save_arrays(directory, **arrays):
+    tmp_directory = directory + ".tmp{}".format(os.getpid())
+    os.makedirs(tmp_directory, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_directory, name + ".npy"), values)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+
+
+# Returns:
+# arrays = A list with the arrays <directory>/<name>.npy in the order of names
+#          (memory-mapped read-only when mmap is True, so nothing is read until it is used)
+def load_arrays(directory, names, mmap=False):
+    mmap_mode = "r" if mmap else None
+    return [np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode) for name in names]
+
+
+# The documents of one split in the flatten_documents layout (plain or memory-mapped arrays).
+# Item index is (index, word ids of document index, label); the collate functions of ffnn.py and
+# rnn.py turn a list of items into a minibatch.
+class DocumentDataset(Dataset):
+    def __init__(self, ids, offsets, labels):
+        self.ids = ids
+        self.offsets = offsets
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return index, self.ids[self.offsets[index]:self.offsets[index + 1]], int(self.labels[index])
+
+    # Returns:
+    # lengths = A list with the number of words of each document
+    def lengths(self):
+        return np.diff(self.offsets).tolist()
+
+
+# Keeps each worker process to one intra-op thread, so that the workers do not compete with the
+# training process for the cores.
+def init_worker(worker_id):
+    torch.set_num_threads(1)
+
+
+# Returns:
+# loader = A DataLoader over dataset. With num_workers > 0 the minibatches are collated in that many
+#          worker processes, each keeping prefetch_factor minibatches ready ahead of the training loop.
+#          Either batch_sampler or batch_size (with shuffle and drop_last) chooses the minibatches.
+#          Each pass over the loader draws a seed from generator (the global torch generator by default).
+#          With shuffle_generator, the shuffle draws from it instead, and from nothing else: reseeding it
+#          before an epoch fixes the order of that epoch, however many workers there are and whatever
+#          ran before.
+def make_loader(dataset, collate_fn, batch_sampler=None, batch_size=1, shuffle=False, drop_last=False,
+                num_workers=0, pin_memory=False, prefetch_factor=2, generator=None, shuffle_generator=None):
+    if batch_sampler is not None:
+        batching = {"batch_sampler": batch_sampler}
+    elif shuffle and shuffle_generator is not None:
+        batching = {"batch_sampler": BatchSampler(RandomSampler(dataset, generator=shuffle_generator),
+                                                  batch_size, drop_last)}
+    else:
+        batching = {"batch_size": batch_size, "shuffle": shuffle, "drop_last": drop_last}
+    workers = {}
+    if num_workers > 0:
+        workers = {"worker_init_fn": init_worker, "prefetch_factor": prefetch_factor, "persistent_workers": True}
+    return DataLoader(dataset, collate_fn=collate_fn, num_workers=num_workers, pin_memory=pin_memory,
+                      generator=generator, **batching, **workers)
+
+
+# Adds the DataLoader options to an ArgumentParser
+def add_loader_arguments(parser):
+    parser.add_argument("--num_workers", type=int, default = 0, help = "worker processes that collate minibatches")
+    parser.add_argument("--pin_memory", action='store_true', help = "collate minibatches into pinned memory")
+    parser.add_argument("--prefetch_factor", type=int, default = 2, help = "minibatches each worker prepares ahead")
+
+
+# Yields minibatches (lists of example indices) whose documents have similar lengths, so that
+# padding a minibatch to its longest document wastes few timesteps.
+#
+# Every epoch the examples are shuffled, grouped into buckets of width bucket_width tokens
+# (lengths 0..w-1, w..2w-1, ...), laid out bucket after bucket and cut into minibatches; the
+# order of the minibatches is then shuffled again. A wider bucket keeps more randomness inside
+# each minibatch at the price of more padding; bucket_width = 0 turns bucketing off (plain
+# shuffle). With shuffle = False the minibatches simply follow increasing length, which is the
+# cheapest order for evaluation.
+#
+# After (or during) an epoch, real_tokens / padded_tokens give the padding efficiency of the
+# minibatches yielded so far in that epoch.
+#
+# For data-parallel training each of num_replicas processes builds the same sampler with its own
+# rank and an rng seeded alike: they all lay out the same minibatches, and replica rank takes every
+# num_replicas-th of them, starting at the rank-th.
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, bucket_width=10, shuffle=True, drop_last=False, rng=random,
+                 num_replicas=1, rank=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rng = rng # the random module by default, so random.seed() controls the order
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def __len__(self):
+        if self.drop_last:
+            batches = len(self.lengths) // self.batch_size
+        else:
+            batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return batches // self.num_replicas
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            self.rng.shuffle(indices)
+        if self.bucket_width > 0:
+            if self.shuffle:
+                # stable sort: documents inside one bucket keep their shuffled order
+                indices.sort(key=lambda index: self.lengths[index] // self.bucket_width)
+            else:
+                indices.sort(key=lambda index: self.lengths[index])
+
+        batches = [indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            self.rng.shuffle(batches)
+        # every replica takes as many minibatches as the others, or the gradient all-reduce of the
+        # last steps would wait forever
+        shard_size = len(batches) // self.num_replicas
+        batches = batches[self.rank:shard_size * self.num_replicas:self.num_replicas]
+
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        for batch in batches:
+            batch_lengths = [self.lengths[index] for index in batch]
+            self.real_tokens += sum(batch_lengths)
+            self.padded_tokens += max(batch_lengths) * len(batch)
+            yield batch
+
+    # Returns:
+    # efficiency = real tokens / (real + padding tokens) over the minibatches of the current epoch
+    def padding_efficiency(self):
+        if self.padded_tokens == 0:
+            return 1.0
+        return self.real_tokens / self.padded_tokens
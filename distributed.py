@@ -0,0 +1,171 @@
+import csv
+import json
+import os
+import random
+import socket
+import time
+from argparse import ArgumentParser
+from functools import partial
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from data_utils import DocumentDataset
+from preprocess import load_split, load_meta
+from checkpoint import save_model, build_model, make_optimizer, make_train_loader, train_epoch
+from evaluate import make_eval_loader, evaluate
+
+
+# Data-parallel training of ffnn.py / rnn.py models on one machine: every worker process holds a
+# DistributedDataParallel copy of the model, trains on its own shard of the minibatches of a
+# preprocess.py dataset (memory-mapped, so the workers share one copy of it) and the gradients are
+# averaged over the workers with a gloo all-reduce after each backward pass. --batch_size is per
+# worker, so a step of n workers covers n * batch_size documents.
+#
+# With several worker counts (--workers 1 2 4) the same training runs once per count, and the
+# throughput of each is compared with that of the smallest count:
+#   speedup = throughput / smallest count's throughput
+#   scaling_efficiency = speedup / (workers / smallest count), 1.0 being linear scaling
+
+
+# Returns:
+# port = A TCP port on localhost that nothing is listening on
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Collates RNN items like rnn.collate_padded, with the word ids of the PackedSequence looked up in
+# embedding, so that the model gets word vectors (bind embedding with functools.partial)
+def collate_embedded(examples, embedding):
+    from rnn import collate_padded
+    indices, inputs, gold_labels = collate_padded(examples)
+    return indices, inputs._replace(data=embedding(inputs.data)), gold_labels
+
+
+# The training run of one worker process (started by torch.multiprocessing.spawn). Rank 0 validates,
+# saves the model and puts the per-epoch records on results.
+def train_worker(rank, world_size, port, args, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(args.threads_per_worker or max(1, (os.cpu_count() or 1) // world_size))
+    # the same seeds everywhere: equal initial weights and the same minibatch layout on every worker
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    meta = load_meta(args.data_dir)
+    model, collate_fn, model_config, vocab = build_model(args, meta)
+    optimizer = make_optimizer(args.model, model)
+    embedding = None
+    if args.model == "rnn" and not args.fine_tune_embedding:
+        # a frozen embedding is the same memory-mapped file on every worker. DDP broadcasts the
+        # parameters of the module it wraps, which would write into the read-only map, so the
+        # embedding is taken out of the model and the ids are looked up while collating instead
+        embedding, model.embedding = model.embedding, None
+        collate_fn = partial(collate_embedded, embedding=embedding)
+    ddp_model = DistributedDataParallel(model, device_ids=None)
+
+    train_dataset = DocumentDataset(*load_split(args.data_dir, "train"))
+    train_loader = make_train_loader(args.model, train_dataset, collate_fn, args.batch_size, args.bucket_width,
+                                     args.seed, num_replicas=world_size, rank=rank)
+    if rank == 0:
+        valid_dataset = DocumentDataset(*load_split(args.data_dir, "valid"))
+        valid_loader = make_eval_loader(valid_dataset, collate_fn)
+
+    records = []
+    for epoch in range(args.epochs):
+        dist.barrier()
+        start_time = time.perf_counter()
+        # the gradients are all-reduced by ddp_model during each backward pass
+        correct = torch.tensor(train_epoch(model, optimizer, train_loader, ddp_model)) # correct, total
+        dist.barrier()
+        train_time = time.perf_counter() - start_time
+        dist.all_reduce(correct)
+
+        if rank == 0:
+            examples = int(correct[1])
+            record = {"workers": world_size, "epoch": epoch + 1, "train_time": train_time, "examples": examples,
+                      "examples_per_sec": examples / train_time, "train_accuracy": int(correct[0]) / examples,
+                      "validation_accuracy": evaluate(model, valid_loader)}
+            print("[{} workers] epoch {}: {:.1f} examples/sec, training accuracy {:.4f}, validation accuracy {:.4f}".format(
+                world_size, epoch + 1, record["examples_per_sec"], record["train_accuracy"],
+                record["validation_accuracy"]))
+            records.append(record)
+        dist.barrier()
+
+    if rank == 0:
+        if embedding is not None:
+            model.embedding = embedding
+        if args.save_model is not None:
+            save_model(args.save_model, args.model, model, model_config, vocab)
+        results.put(records)
+    dist.destroy_process_group()
+
+
+# Returns:
+# rows = One summary per worker count: throughput over the epochs after the first (all epochs if there
+#        is only one), final accuracies, speedup and scaling efficiency against the smallest count
+def scaling_report(records_by_workers):
+    rows = []
+    for workers, records in sorted(records_by_workers.items()):
+        timed = records[1:] or records # the first epoch also pays for process and thread start-up
+        rows.append({"workers": workers,
+                     "examples_per_sec": sum(r["examples"] for r in timed) / sum(r["train_time"] for r in timed),
+                     "train_accuracy": records[-1]["train_accuracy"],
+                     "validation_accuracy": records[-1]["validation_accuracy"]})
+    base = rows[0]
+    for row in rows:
+        row["speedup"] = row["examples_per_sec"] / base["examples_per_sec"]
+        row["scaling_efficiency"] = row["speedup"] / (row["workers"] / base["workers"])
+    return rows
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", choices = ["ffnn", "rnn"], required = True, help = "model to train")
+    parser.add_argument("--data_dir", required = True, help = "dataset written by preprocess.py for --model")
+    parser.add_argument("-hd", "--hidden_dim", type=int, required = True, help = "hidden_dim")
+    parser.add_argument("-e", "--epochs", type=int, required = True, help = "num of epochs to train")
+    parser.add_argument("-b", "--batch_size", type=int, default = 16, help = "minibatch size of each worker")
+    parser.add_argument("--workers", type=int, nargs="+", default = [2],
+                        help = "worker processes; several counts are run one after another and compared")
+    parser.add_argument("--threads_per_worker", type=int, default = None,
+                        help = "torch intra-op threads of each worker (default: the cores divided among the workers)")
+    parser.add_argument("--bucket_width", type=int, default = 10, help = "RNN: length bucket width of the minibatches")
+    parser.add_argument("--fine_tune_embedding", action='store_true', help = "RNN: train the embedding along with the RNN")
+    parser.add_argument("--seed", type=int, default = 42, help = "seed of the weights and minibatch order")
+    parser.add_argument("--save_model", default = None,
+                        help = "path to save the model trained by the last worker count to (for predict.py)")
+    args = parser.parse_args()
+    if load_meta(args.data_dir)["model"] != args.model:
+        parser.error("{} was preprocessed for another model".format(args.data_dir))
+
+    context = mp.get_context("spawn")
+    records_by_workers = {}
+    for world_size in args.workers:
+        print("========== Training with {} workers ==========".format(world_size))
+        results = context.SimpleQueue()
+        mp.spawn(train_worker, args=(world_size, free_port(), args, results), nprocs=world_size)
+        records_by_workers[world_size] = results.get()
+
+    rows = scaling_report(records_by_workers)
+    print("========== Scaling ==========")
+    for row in rows:
+        print("{workers} workers: {examples_per_sec:.1f} examples/sec, speedup {speedup:.2f}, "
+              "scaling efficiency {scaling_efficiency:.2f}, validation accuracy {validation_accuracy:.4f}".format(**row))
+
+    os.makedirs("results", exist_ok=True)
+    prefix = os.path.join("results", "distributed_" + args.model)
+    with open(prefix + ".json", "w") as f:
+        json.dump({"args": vars(args), "scaling": rows, "epochs": records_by_workers}, f, indent=2)
+    with open(prefix + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Results written to {}.json and {}.csv".format(prefix, prefix))
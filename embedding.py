@@ -0,0 +1,106 @@
+import os
+import pickle
+import shutil
+import warnings
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from data_utils import save_words, load_words, file_digest
+
+
+# A converted embedding is a directory holding
+#   embedding.npy = A contiguous (V, d) float32 matrix, one row per word
+#   vocab.txt     = The V words, one per line, in the order of the rows
+#   source.sha1   = The SHA-1 of the pickle it was converted from
+# Unlike the pickled dict of lists it loads without unpickling anything, and memory-mapping the
+# matrix lets every process that reads it share the same pages of the page cache. Preprocessed datasets
+# and saved RNN models record the directory along with the vocab_digest of its vocabulary, since a
+# reconverted pickle may hold other words or rows.
+MATRIX_FILE = "embedding.npy"
+VOCAB_FILE = "vocab.txt"
+SOURCE_FILE = "source.sha1"
+
+
+def convert_embedding(pkl_path, out_dir):
+    with open(pkl_path, "rb") as f:
+        word_embedding = pickle.load(f)
+    words = list(word_embedding)
+    matrix = np.asarray([word_embedding[word] for word in words], dtype=np.float32)
+
+    # written to a temporary directory that is renamed into place at the end (as save_arrays does):
+    # a process that has the old embedding.npy memory-mapped keeps reading the old, unlinked file
+    # instead of one truncated and rewritten under it, and an interrupted conversion leaves nothing behind
+    tmp_dir = out_dir + ".tmp{}".format(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, MATRIX_FILE), matrix)
+    save_words(os.path.join(tmp_dir, VOCAB_FILE), words)
+    with open(os.path.join(tmp_dir, SOURCE_FILE), "w") as f:
+        f.write(file_digest(pkl_path) + "\n")
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+
+# Returns:
+# directory = The converted embedding directory for path. A .pkl path is converted the first time,
+#             into a directory next to it with the same name minus the extension, and again whenever
+#             the content of the pickle no longer matches the SHA-1 recorded at conversion.
+def embedding_directory(path):
+    if not path.endswith(".pkl"):
+        return path
+    out_dir = os.path.splitext(path)[0]
+    digest = file_digest(path)
+    source_path = os.path.join(out_dir, SOURCE_FILE)
+    converted = None
+    if os.path.isfile(source_path) and os.path.isfile(os.path.join(out_dir, VOCAB_FILE)):
+        with open(source_path) as f:
+            converted = f.read().strip()
+    if converted != digest:
+        print("Converting {} to {}".format(path, out_dir))
+        convert_embedding(path, out_dir)
+    return out_dir
+
+
+# Returns:
+# words = A list with the word of each row of the matrix
+def load_vocab(directory):
+    return load_words(os.path.join(directory, VOCAB_FILE))
+
+
+# Returns:
+# digest = The file_digest of the vocabulary of the embedding directory
+def vocab_digest(directory):
+    return file_digest(os.path.join(directory, VOCAB_FILE))
+
+
+# Raises a ValueError unless the vocabulary of the embedding directory is still the one digest was taken
+# of when name (a dataset or a saved model) was built on it: word ids or weights made for the rows of
+# an earlier conversion would silently be paired with other words.
+def check_vocab(directory, digest, name):
+    if digest != vocab_digest(directory):
+        raise ValueError("{} was built on another version of the embedding {}; build it again".format(name, directory))
+
+
+# Returns:
+# matrix = The (V, d) embedding matrix as a float tensor. Without fine_tune it is backed by a
+#          read-only memory map of embedding.npy; with fine_tune it is copied into writable memory.
+def load_matrix(directory, fine_tune=False):
+    matrix = np.load(os.path.join(directory, MATRIX_FILE), mmap_mode="r")
+    if fine_tune:
+        return torch.from_numpy(np.array(matrix))
+    with warnings.catch_warnings():
+        # the memory map is read-only on purpose; a frozen embedding never writes to it
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(matrix)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--pkl", default = "./word_embedding.pkl", help = "path to the pickled word embedding")
+    parser.add_argument("--out_dir", default = None, help = "output directory (default: the .pkl path without extension)")
+    args = parser.parse_args()
+
+    out_dir = args.out_dir or os.path.splitext(args.pkl)[0]
+    convert_embedding(args.pkl, out_dir)
+    print("Wrote {} and {} to {}".format(MATRIX_FILE, VOCAB_FILE, out_dir))
@@ -0,0 +1,101 @@
+import heapq
+import json
+import os
+import random
+
+import torch
+
+
+NUM_CLASSES = 5
+
+
+# Collects the misclassified documents of each split ("train", "validation") epoch by epoch in bounded
+# memory: per epoch and split it keeps only size of them, either a uniform reservoir sample of all the
+# errors (selection "reservoir") or the ones predicted with the highest confidence ("confident"), as
+# document indices rather than text, together with the 5 x 5 confusion matrix of the epoch.
+# end() appends the epoch's record to path, one JSON line:
+#   {"epoch", "split", "documents", "errors",
+#    "confusion": [[count of gold i predicted j stars for j in 1..5] for i in 1..5],
+#    "samples": [{"index", "gold", "predicted", "confidence"}, ...]}
+# with gold and predicted in stars (label + 1), as in the predictions files.
+# The reservoir draws from its own random.Random(seed), so collecting errors leaves the training
+# random state alone.
+class ErrorSink:
+    def __init__(self, path, size=10, selection="reservoir", seed=0, append=False):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a" if append else "w")
+        self.size = size
+        self.selection = selection
+        self.rng = random.Random(seed)
+        self.epochs = {}
+        self.last = {} # split: record of the last epoch that ended
+
+    def start(self, epoch, split):
+        self.epochs[split] = {"epoch": epoch, "errors": 0, "samples": [],
+                              "confusion": torch.zeros(NUM_CLASSES * NUM_CLASSES, dtype=torch.long)}
+
+    # Adds a minibatch of split; with functools.partial(sink.add, split) it is an on_batch callback of
+    # evaluate.evaluate
+    def add(self, split, indices, predicted_labels, gold_labels, log_probabilities):
+        state = self.epochs[split]
+        state["confusion"] += torch.bincount(gold_labels * NUM_CLASSES + predicted_labels,
+                                             minlength=NUM_CLASSES * NUM_CLASSES)
+        wrong = torch.nonzero(predicted_labels != gold_labels).flatten()
+        if len(wrong) == 0:
+            return
+        confidences = torch.exp(log_probabilities.detach()[wrong, predicted_labels[wrong]])
+        samples = state["samples"]
+        for sample in zip(confidences.tolist(), indices[wrong].tolist(), gold_labels[wrong].tolist(),
+                          predicted_labels[wrong].tolist()):
+            state["errors"] += 1
+            if self.selection == "confident":
+                # a min-heap on confidence: the least confident kept error goes first
+                if len(samples) < self.size:
+                    heapq.heappush(samples, sample)
+                else:
+                    heapq.heappushpop(samples, sample)
+            elif len(samples) < self.size:
+                samples.append(sample)
+            else:
+                slot = self.rng.randrange(state["errors"])
+                if slot < self.size:
+                    samples[slot] = sample
+
+    # Closes the epoch of split and writes its record.
+    # Returns:
+    # record = The record written (see ErrorSink)
+    def end(self, split):
+        state = self.epochs.pop(split)
+        confusion = state["confusion"].view(NUM_CLASSES, NUM_CLASSES)
+        samples = state["samples"]
+        if self.selection == "confident":
+            samples = sorted(samples, reverse=True)
+        record = {"epoch": state["epoch"], "split": split, "documents": int(confusion.sum()), "errors": state["errors"],
+                  "confusion": confusion.tolist(),
+                  "samples": [{"index": index, "gold": gold + 1, "predicted": predicted + 1, "confidence": round(confidence, 6)}
+                              for confidence, index, gold, predicted in samples]}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.last[split] = record
+        return record
+
+    def close(self):
+        self.file.close()
+
+
+# Returns:
+# text = The confusion matrix of a record as a table of stars, gold in rows and predicted in columns
+def format_confusion(confusion):
+    lines = ["gold \\ predicted" + "".join("{:>8}".format(stars) for stars in range(1, NUM_CLASSES + 1))]
+    for stars, row in enumerate(confusion, start=1):
+        lines.append("{:>16}".format(stars) + "".join("{:>8}".format(count) for count in row))
+    return "\n".join(lines) + "\n"
+
+
+# Adds the error-sample options to an ArgumentParser
+def add_error_arguments(parser):
+    parser.add_argument("--error_samples", type=int, default = 10, help = "misclassified documents kept per epoch and split")
+    parser.add_argument("--error_selection", choices = ["reservoir", "confident"], default = "reservoir",
+                        help = "keep a uniform sample of the errors, or the most confidently wrong ones")
@@ -0,0 +1,52 @@
+import random
+
+import torch
+
+from data_utils import make_loader
+
+
+# Returns:
+# loader = A DataLoader over every document of dataset (or over a fixed random subsample of subsample
+#          documents) in minibatches of batch_size. The documents go by increasing length, so that the
+#          RNN pads little; nothing is dropped. The loader has a torch generator of its own, so that
+#          however often it is run, the random state of training stays the same.
+def make_eval_loader(dataset, collate_fn, batch_size=1024, subsample=None, seed=0, **loader_options):
+    lengths = dataset.lengths()
+    indices = range(len(lengths))
+    if subsample is not None and subsample < len(lengths):
+        indices = random.Random(seed).sample(indices, subsample)
+    indices = sorted(indices, key=lengths.__getitem__)
+    batches = [indices[start:start + batch_size] for start in range(0, len(indices), batch_size)]
+    return make_loader(dataset, collate_fn, batch_sampler=batches, generator=torch.Generator(), **loader_options)
+
+
+# Scores every minibatch of loader under torch.inference_mode (no autograd graph, no gradients) and puts
+# model back in the mode it was in, so that it can be called in the middle of an epoch.
+# on_batch, if given, is called with (indices, predicted_labels, gold_labels, log_probabilities) of each
+# minibatch, e.g. to collect error samples.
+# Returns:
+# accuracy = The accuracy over the documents of loader
+def evaluate(model, loader, on_batch=None):
+    was_training = model.training
+    model.eval()
+    correct = 0
+    total = 0
+    with torch.inference_mode():
+        for indices, inputs, gold_labels in loader:
+            output = model(inputs)
+            predicted_labels = torch.argmax(output, dim=1)
+            correct += int((predicted_labels == gold_labels).sum())
+            total += len(gold_labels)
+            if on_batch is not None:
+                on_batch(indices, predicted_labels, gold_labels, output)
+    model.train(was_training)
+    return correct / total if total else 0.0
+
+
+# Adds the evaluation options to an ArgumentParser
+def add_eval_arguments(parser):
+    parser.add_argument("--eval_batch_size", type=int, default = 1024, help = "validation documents per minibatch")
+    parser.add_argument("--eval_every", type=int, default = 0,
+                        help = "also report validation accuracy every K training steps (0 = only after each epoch)")
+    parser.add_argument("--eval_subsample", type=int, default = None,
+                        help = "validate on this many randomly chosen documents (the same ones every time) instead of all")
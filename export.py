@@ -0,0 +1,165 @@
+import io
+import json
+import os
+import time
+import warnings
+from argparse import ArgumentParser
+from itertools import islice
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+
+from checkpoint import load_model
+from data_utils import iter_json_records
+from serve import Predictor, SERVING_FILE, VOCAB_FILE
+
+
+# The serving form of an FFNN: the bag of words is an EmbeddingBag sum over the rows of W1 (transposed),
+# which is what the sparse addmm of FFNN.forward computes, and which can be quantized row by row.
+# forward takes the flat ids of the documents and the offset at which each document starts.
+class ServingFFNN(nn.Module):
+    def __init__(self, model):
+        super(ServingFFNN, self).__init__()
+        weight = model.W1.weight.detach().t().contiguous()
+        self.bag = nn.EmbeddingBag.from_pretrained(weight, mode="sum")
+        self.bias = nn.Parameter(model.W1.bias.detach().clone())
+        self.W2 = nn.Linear(model.W2.in_features, model.W2.out_features)
+        self.W2.load_state_dict(model.W2.state_dict())
+
+    def forward(self, ids, offsets):
+        h = torch.relu(self.bag(ids, offsets) + self.bias)
+        return torch.log_softmax(self.W2(h), dim=-1)
+
+
+# The serving form of an RNN. forward takes (T, B) padded word ids and the length of each document;
+# the final hidden state of a document is its output at its own last word, as with a PackedSequence.
+class ServingRNN(nn.Module):
+    def __init__(self, model):
+        super(ServingRNN, self).__init__()
+        self.embedding = nn.Embedding.from_pretrained(model.embedding.weight.detach().clone())
+        self.rnn = nn.RNN(model.rnn.input_size, model.rnn.hidden_size, model.rnn.num_layers, nonlinearity='tanh')
+        self.rnn.load_state_dict(model.rnn.state_dict())
+        self.W = nn.Linear(model.W.in_features, model.W.out_features)
+        self.W.load_state_dict(model.W.state_dict())
+
+    def forward(self, ids, lengths):
+        output, _ = self.rnn(self.embedding(ids))
+        hidden = output[lengths - 1, torch.arange(ids.shape[1])]
+        return torch.log_softmax(self.W(hidden), dim=-1)
+
+
+# Dynamic int8 quantization of a serving module: Linear layers get int8 weights and quantize their inputs
+# on the fly, word tables (EmbeddingBag / Embedding) keep int8 rows with a float scale each. nn.RNN has no
+# dynamic int8 kernel and stays in float.
+def quantize(module):
+    with warnings.catch_warnings():
+        # torch.ao.quantization and its quantized tensors announce their move to torchao; the eager API
+        # still does the job. Every other warning is shown.
+        warnings.filterwarnings("ignore", message="torch.ao.quantization is deprecated", category=DeprecationWarning)
+        warnings.filterwarnings("ignore", message="torch.quantize_per_tensor, torch.quantize_per_channel and other "
+                                "quantized tensor creation functions", category=UserWarning)
+        return quantize_dynamic(module, {nn.Linear: default_dynamic_qconfig,
+                                         nn.EmbeddingBag: float_qparams_weight_only_qconfig,
+                                         nn.Embedding: float_qparams_weight_only_qconfig})
+
+
+# Returns:
+# predictor = A Predictor over the TorchScript serving form of the saved model at checkpoint_path,
+#             quantized or not
+def build_predictor(checkpoint_path, quantized=False):
+    model, checkpoint = load_model(checkpoint_path)
+    config = checkpoint["config"]
+    if checkpoint["model"] == "ffnn":
+        module = ServingFFNN(model)
+        words = checkpoint["vocab"] or []
+    else:
+        from embedding import load_vocab
+        module = ServingRNN(model)
+        words = load_vocab(config["embedding"])
+    module.eval()
+    if quantized:
+        module = quantize(module)
+    serving = {"model": checkpoint["model"], "quantized": quantized,
+               "hash_buckets": config.get("hash_buckets"), "bigrams": config.get("bigrams", False)}
+    return Predictor(torch.jit.script(module), serving, words)
+
+
+# Writes the predictor's module and what serve.py needs to feed it to path (or an open binary file)
+def save_predictor(predictor, path):
+    extra_files = {SERVING_FILE: json.dumps(predictor.serving),
+                   VOCAB_FILE: "".join(word + "\n" for word in predictor.word2id)}
+    torch.jit.save(predictor.module, path, _extra_files=extra_files)
+
+
+# Scores the reviews of data_path in minibatches of batch_size, reading one minibatch at a time.
+# Returns:
+# stats = A dict with the accuracy, docs/sec and p50/p99 per-minibatch latency in ms (text to probabilities)
+# predicted_labels = The predicted label of each review
+def score(predictor, data_path, batch_size):
+    # untimed: TorchScript optimizes a module over its first calls
+    predictor.predict([record["text"] for record in islice(iter_json_records(data_path), batch_size)])
+    records = iter_json_records(data_path)
+    latencies = []
+    predicted_labels = []
+    gold_labels = []
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        batch_start = time.perf_counter()
+        probabilities = predictor.predict([record["text"] for record in batch])
+        latencies.append(time.perf_counter() - batch_start)
+        predicted_labels.extend(torch.argmax(probabilities, dim=1).tolist())
+        gold_labels.extend(int(record["stars"] - 1) for record in batch)
+    latencies_ms = np.array(latencies) * 1000
+    return {"documents": len(predicted_labels),
+            "accuracy": float(np.mean(np.array(predicted_labels) == np.array(gold_labels))),
+            "docs_per_sec": len(predicted_labels) / sum(latencies),
+            "p50_batch_ms": float(np.percentile(latencies_ms, 50)),
+            "p99_batch_ms": float(np.percentile(latencies_ms, 99))}, predicted_labels
+
+
+# Returns:
+# size = The size in MB of the predictor's artifact
+def artifact_size_mb(predictor):
+    buffer = io.BytesIO()
+    save_predictor(predictor, buffer)
+    return buffer.tell() / (1024 * 1024)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint", required = True, help = "model saved by ffnn.py/rnn.py --save_model (or a checkpoint)")
+    parser.add_argument("--output", required = True, help = "path of the TorchScript artifact for serve.py")
+    parser.add_argument("--quantize", action='store_true', help = "apply dynamic int8 quantization")
+    parser.add_argument("--compare", default = None,
+                        help = "labelled data (e.g. validation.json) to compare the float and int8 models on")
+    parser.add_argument("-b", "--batch_size", type=int, default = 1024, help = "reviews per minibatch when comparing")
+    args = parser.parse_args()
+
+    predictor = build_predictor(args.checkpoint, quantized=args.quantize)
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    save_predictor(predictor, args.output)
+    print("{} model written to {}".format("int8" if args.quantize else "Float", args.output))
+
+    if args.compare is not None:
+        predictors = {"float": build_predictor(args.checkpoint), "int8": build_predictor(args.checkpoint, quantized=True)}
+        comparison = {}
+        predictions = {}
+        for name, candidate in predictors.items():
+            comparison[name], predictions[name] = score(candidate, args.compare, args.batch_size)
+            comparison[name]["size_mb"] = artifact_size_mb(candidate)
+        comparison["agreement"] = float(np.mean(np.array(predictions["float"]) == np.array(predictions["int8"])))
+        for name in predictors:
+            print("{:>5}: accuracy {accuracy:.4f}, {docs_per_sec:.1f} docs/sec, p50 {p50_batch_ms:.2f} ms, "
+                  "p99 {p99_batch_ms:.2f} ms, {size_mb:.2f} MB".format(name, **comparison[name]))
+        print("int8 predictions agreeing with float: {:.4f}".format(comparison["agreement"]))
+        os.makedirs("results", exist_ok=True)
+        path = os.path.join("results", "export_{}.json".format(predictor.serving["model"]))
+        with open(path, "w") as f:
+            json.dump({"checkpoint": args.checkpoint, "data": args.compare, **comparison}, f, indent=2)
+        print("Comparison written to {}".format(path))
@@ -4,12 +4,23 @@ import torch.nn as nn
 from torch.nn import init
 import torch.optim as optim
 import math
+import heapq
 import random
 import os
 import time
 from tqdm import tqdm
-import json
+import zlib
 from argparse import ArgumentParser
+from collections import Counter
+from functools import partial
+from data_utils import stream_data, read_texts, flatten_documents, load_words
+from data_utils import DocumentDataset, make_loader, add_loader_arguments
+from preprocess import load_split, load_meta, split_source, VOCAB_FILE
+from checkpoint import save_model, save_checkpoint, load_checkpoint, add_checkpoint_arguments
+from predict import predict, print_stats, write_stats
+from profiling import PhaseProfiler, print_profile, add_profile_arguments
+from evaluate import make_eval_loader, evaluate, add_eval_arguments
+from errors import ErrorSink, format_confusion, add_error_arguments
 
 
 unk = '<UNK>'
@@ -24,7 +35,7 @@ class FFNN(nn.Module):
         self.output_dim = 5
         self.W2 = nn.Linear(h, self.output_dim)
 
-        self.softmax = nn.LogSoftmax() # The softmax function that converts vectors into probability distributions; computes log probabilities for computational benefits
+        self.softmax = nn.LogSoftmax(dim=-1) # The softmax function that converts vectors into probability distributions; computes log probabilities for computational benefits
         self.loss = nn.NLLLoss() # The cross-entropy/negative log likelihood loss taught in class
 
     def compute_Loss(self, predicted_vector, gold_label):
@@ -32,7 +43,11 @@ class FFNN(nn.Module):
 
     def forward(self, input_vector):
         # [to fill] obtain first hidden layer representation
-        h = self.activation(self.W1(input_vector))  # computes the first hidden layer representation
+        if input_vector.is_sparse:
+            # sparse bag-of-words rows: only the non-zero word counts are multiplied into W1
+            h = self.activation(torch.addmm(self.W1.bias, input_vector, self.W1.weight.t()))
+        else:
+            h = self.activation(self.W1(input_vector))  # computes the first hidden layer representation
         
         # [to fill] obtain output layer representation
         z = self.W2(h)                              # computes the output layer representation
@@ -43,71 +58,108 @@ class FFNN(nn.Module):
         return predicted_vector
 
 
-# Returns: 
-# vocab = A set of strings corresponding to the vocabulary
-def make_vocab(data):
-    vocab = set()
+# Counts the words of data in one pass (data may be any iterable of (document, y) pairs, e.g. a
+# stream_data generator); words seen fewer than min_freq times are left out, and with max_size only
+# the max_size most frequent words are kept (ties broken alphabetically). Every word left out reads
+# as <UNK>, and each one saves a row of W1.
+# Returns:
+# vocab = A sorted list of strings corresponding to the vocabulary, without <UNK>
+def make_vocab(data, min_freq=1, max_size=None):
+    counts = Counter()
     for document, _ in data:
-        for word in document:
-            vocab.add(word)
-    return vocab 
+        counts.update(document)
+    counts.pop(unk, None)
+    words = [word for word, count in counts.items() if count >= min_freq]
+    if max_size is not None and len(words) > max_size:
+        words = heapq.nsmallest(max_size, words, key=lambda word: (-counts[word], word))
+    return sorted(words)
 
 
 # Returns:
-# vocab = A set of strings corresponding to the vocabulary including <UNK>
 # word2index = A dictionary mapping word/token to its index (a number in 0, ..., V - 1)
-# index2word = A dictionary inverting the mapping of word2index
+# index2word = A list mapping each index back to its word: vocab followed by <UNK>
 def make_indices(vocab):
-    vocab_list = sorted(vocab)
-    vocab_list.append(unk)
-    word2index = {}
-    index2word = {}
-    for index, word in enumerate(vocab_list):
-        word2index[word] = index 
-        index2word[index] = word 
-    vocab.add(unk)
-    return vocab, word2index, index2word 
+    index2word = list(vocab) + [unk]
+    word2index = dict(zip(index2word, range(len(index2word))))
+    return word2index, index2word
 
 
+# Converts data, any iterable of (document, y) pairs such as a stream_data generator.
 # Returns:
-# vectorized_data = A list of pairs (vector representation of input, y)
-def convert_to_vector_representation(data, word2index):
-    vectorized_data = []
-    for document, y in data:
-        vector = torch.zeros(len(word2index)) 
-        for word in document:
-            index = word2index.get(word, word2index[unk])
-            vector[index] += 1
-        vectorized_data.append((document, vector, y))
-    return vectorized_data
+# ids = A flat int32 array with the index of every word of every document (unknown words map to <UNK>)
+# offsets = An int64 array of length N + 1; document i is ids[offsets[i]:offsets[i + 1]]
+# labels = An int64 array with the N labels
+def convert_to_ids(data, word2index):
+    unk_index = word2index[unk]
+    return flatten_documents(([word2index.get(word, unk_index) for word in document], y) for document, y in data)
 
 
+# Returns:
+# features = The bucket (a number in 0, ..., buckets - 1) of each word of document, followed with bigrams
+#            by the bucket of each pair of adjacent words. Buckets come from CRC-32, which unlike hash()
+#            is the same in every process, so a saved model hashes new text the way it was trained.
+def hash_features(document, buckets, bigrams=False):
+    features = [zlib.crc32(word.encode()) % buckets for word in document]
+    if bigrams:
+        features.extend(zlib.crc32((first + " " + second).encode()) % buckets
+                        for first, second in zip(document, document[1:]))
+    return features
 
-def load_data(train_data, val_data):
-    with open(train_data) as training_f:
-        training = json.load(training_f)
-    with open(val_data) as valid_f:
-        validation = json.load(valid_f)
 
-    tra = []
-    val = []
-    for elt in training:
-        tra.append((elt["text"].split(),int(elt["stars"]-1)))
-    for elt in validation:
-        val.append((elt["text"].split(),int(elt["stars"]-1)))
+# Converts data like convert_to_ids, but into hashed features: no vocabulary is needed, the input
+# dimension is buckets however many distinct words the corpus holds, and unseen words still get
+# their own (shared) buckets instead of <UNK>.
+# Returns:
+# ids, offsets, labels = As for convert_to_ids, with the features of hash_features as ids
+def convert_to_hashed_ids(data, buckets, bigrams=False):
+    return flatten_documents((hash_features(document, buckets, bigrams), y) for document, y in data)
 
-    return tra, val
+
+# Collates DocumentDataset items into a bag-of-words minibatch (bind vocab_size with functools.partial).
+# Returns:
+# indices = A (B,) long tensor with the dataset index of each document
+# input_batch = A sparse (B, V) tensor with the word counts of the documents; only the words that
+#               occur are stored, so memory scales with the token count instead of the vocabulary
+# gold_labels = A (B,) long tensor of labels
+def collate_bag_of_words(examples, vocab_size):
+    indices, documents, labels = zip(*examples)
+    lengths = torch.tensor([len(document) for document in documents])
+    columns = torch.from_numpy(np.concatenate(documents).astype(np.int64))
+    rows = torch.repeat_interleave(torch.arange(len(documents)), lengths)
+    # repeated words are summed into counts by coalesce()
+    input_batch = torch.sparse_coo_tensor(torch.stack([rows, columns]), torch.ones(len(columns)),
+                                          (len(documents), vocab_size), check_invariants=False).coalesce()
+    return torch.tensor(indices), input_batch, torch.tensor(labels)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-hd", "--hidden_dim", type=int, required = True, help = "hidden_dim")
     parser.add_argument("-e", "--epochs", type=int, required = True, help = "num of epochs to train")
-    parser.add_argument("--train_data", required = True, help = "path to training data")
-    parser.add_argument("--val_data", required = True, help = "path to validation data")
+    parser.add_argument("--train_data", default = None, help = "path to training data")
+    parser.add_argument("--val_data", default = None, help = "path to validation data")
+    parser.add_argument("--data_dir", default = None,
+                        help = "dataset written by preprocess.py, used instead of --train_data/--val_data")
     parser.add_argument("--test_data", default = "to fill", help = "path to test data")
-    parser.add_argument('--do_train', action='store_true')
+    parser.add_argument("-b", "--batch_size", type=int, default = 16, help = "minibatch size")
+    parser.add_argument("--min_freq", type=int, default = 1,
+                        help = "leave words seen fewer times in the training data out of the vocabulary (ignored with --data_dir)")
+    parser.add_argument("--max_vocab", type=int, default = None,
+                        help = "keep only this many most frequent training words (ignored with --data_dir)")
+    parser.add_argument("--hash_buckets", type=int, default = None,
+                        help = "hash words into this many input features instead of building a vocabulary (--data_dir: as preprocessed)")
+    parser.add_argument("--bigrams", action='store_true', help = "with --hash_buckets, also hash pairs of adjacent words")
+    add_loader_arguments(parser)
+    add_eval_arguments(parser)
+    add_error_arguments(parser)
+    parser.add_argument("--save_model", default = None, help = "path to save the trained model to (for predict.py)")
+    add_checkpoint_arguments(parser, "ffnn")
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.data_dir is None and (args.train_data is None or args.val_data is None):
+        parser.error("either --data_dir or both --train_data and --val_data are required")
+    if args.bigrams and args.hash_buckets is None:
+        parser.error("--bigrams requires --hash_buckets")
 
     # fix random seeds
     random.seed(42)
@@ -115,30 +167,86 @@ if __name__ == "__main__":
 
     # load data
     print("========== Loading data ==========")
-    train_data, valid_data = load_data(args.train_data, args.val_data) # X_data is a list of pairs (document, y); y in {0,1,2,3,4}
-    vocab = make_vocab(train_data)
-    vocab, word2index, index2word = make_indices(vocab)
+    if args.data_dir is not None:
+        # memory-mapped arrays written by preprocess.py: nothing is parsed or vectorized
+        meta = load_meta(args.data_dir)
+        if meta["model"] != "ffnn":
+            parser.error("{} was preprocessed for another model".format(args.data_dir))
+        args.hash_buckets, args.bigrams = meta.get("hash_buckets"), meta.get("bigrams", False)
+        if args.hash_buckets is None:
+            index2word = load_words(os.path.join(args.data_dir, VOCAB_FILE))
+        train_ids, train_offsets, train_labels = load_split(args.data_dir, "train")
+        valid_ids, valid_offsets, valid_labels = load_split(args.data_dir, "valid")
+        sources = {split: split_source(meta, split) for split in ["train", "valid"]}
+    elif args.hash_buckets is not None:
+        # hashed features: a single pass over each file and no vocabulary at all
+        print("========== Hashing data ==========")
+        train_ids, train_offsets, train_labels = convert_to_hashed_ids(stream_data(args.train_data), args.hash_buckets, args.bigrams)
+        valid_ids, valid_offsets, valid_labels = convert_to_hashed_ids(stream_data(args.val_data), args.hash_buckets, args.bigrams)
+    else:
+        # The data files are streamed as pairs (document, y); y in {0,1,2,3,4}: once to build the vocabulary,
+        # and once more to vectorize, so only the word ids are ever kept in memory as a whole
+        vocab = make_vocab(stream_data(args.train_data), args.min_freq, args.max_vocab)
+        word2index, index2word = make_indices(vocab)
 
-    print("========== Vectorizing data ==========")
-    train_data = convert_to_vector_representation(train_data, word2index)
-    valid_data = convert_to_vector_representation(valid_data, word2index)
-    
+        print("========== Vectorizing data ==========")
+        train_ids, train_offsets, train_labels = convert_to_ids(stream_data(args.train_data), word2index)
+        valid_ids, valid_offsets, valid_labels = convert_to_ids(stream_data(args.val_data), word2index)
+    if args.data_dir is None:
+        sources = {"train": (args.train_data, None), "valid": (args.val_data, None)}
+    vocab_size = args.hash_buckets if args.hash_buckets is not None else len(index2word)
 
-    model = FFNN(input_dim = len(vocab), h = args.hidden_dim)
+    collate_fn = partial(collate_bag_of_words, vocab_size=vocab_size)
+    loader_options = {"num_workers": args.num_workers, "pin_memory": args.pin_memory,
+                      "prefetch_factor": args.prefetch_factor}
+    # Good practice to shuffle order of training data. The shuffle of epoch e is seeded with 42 + e and
+    # the loader has a generator of its own too, so that the order neither depends on --num_workers nor
+    # changes when a run is resumed
+    shuffle_generator = torch.Generator()
+    train_loader = make_loader(DocumentDataset(train_ids, train_offsets, train_labels), collate_fn,
+                               batch_size=args.batch_size, shuffle=True, drop_last=True,
+                               generator=torch.Generator(), shuffle_generator=shuffle_generator, **loader_options)
+    # validation covers every document (or --eval_subsample of them) in minibatches of --eval_batch_size
+    valid_loader = make_eval_loader(DocumentDataset(valid_ids, valid_offsets, valid_labels), collate_fn,
+                                    args.eval_batch_size, args.eval_subsample, seed=42, **loader_options)
+
+    model_config = {"input_dim": vocab_size, "hidden_dim": args.hidden_dim,
+                    "hash_buckets": args.hash_buckets, "bigrams": args.bigrams}
+    vocab_list = list(index2word) if args.hash_buckets is None else None
+    model = FFNN(input_dim = vocab_size, h = args.hidden_dim)
     optimizer = optim.SGD(model.parameters(),lr=0.01, momentum=0.9)
-    print("========== Training for {} epochs ==========".format(args.epochs))
-    
+
     # Lists to store results for each epoch
     train_accuracies = []
     train_times = []
     val_accuracies = []
     val_times = []
+    step_accuracies = [] # {"epoch", "step", "accuracy"} of the --eval_every evaluations
+
+    start_epoch = 0
+    last_checkpoint = os.path.join(args.checkpoint_dir, "last.pt")
+    best_checkpoint = os.path.join(args.checkpoint_dir, "best.pt")
+    if args.resume and os.path.isfile(last_checkpoint):
+        checkpoint = load_checkpoint(last_checkpoint, model, optimizer, model_config, vocab_list)
+        start_epoch = checkpoint["epoch"]
+        train_accuracies, train_times, val_accuracies, val_times = (checkpoint["history"][key] for key in
+            ["train_accuracies", "train_times", "val_accuracies", "val_times"])
+        step_accuracies = checkpoint["history"].get("step_accuracies", [])
+        print("========== Resuming from {} after epoch {} ==========".format(last_checkpoint, start_epoch))
+    best_val_acc = max(val_accuracies, default=-1)
+
+    profiler = PhaseProfiler(trace_path="results/trace_ffnn.json" if args.torch_profile else None)
 
-    error_samples_train = []
-    error_samples_val = []
+    # a bounded sample of the misclassified training and validation documents (their ids) and the
+    # confusion matrices, streamed to disk every epoch
+    error_sink = ErrorSink("error-samples/errors_ffnn.jsonl", args.error_samples, args.error_selection,
+                           append=args.resume and start_epoch > 0)
 
-    
-    for epoch in range(args.epochs):
+    step = start_epoch * len(train_loader)
+    print("========== Training for {} epochs ==========".format(args.epochs))
+    for epoch in range(start_epoch, args.epochs):
+        profiler.start_epoch()
+        shuffle_generator.manual_seed(42 + epoch)
         model.train()
         optimizer.zero_grad()
         loss = None
@@ -146,31 +254,30 @@ if __name__ == "__main__":
         total = 0
         start_time = time.time()
         print("Training started for epoch {}".format(epoch + 1))
-        random.shuffle(train_data) # Good practice to shuffle order of training data
-        minibatch_size = 16 
-        N = len(train_data) 
-        for minibatch_index in tqdm(range(N // minibatch_size)):
-            optimizer.zero_grad()
-            loss = None
-            for example_index in range(minibatch_size):
-                original_text, input_vector, gold_label = train_data[minibatch_index * minibatch_size + example_index]
-                predicted_vector = model(input_vector)
-                predicted_label = torch.argmax(predicted_vector)
-                correct += int(predicted_label == gold_label)
-                total += 1
-                example_loss = model.compute_Loss(predicted_vector.view(1,-1), torch.tensor([gold_label]))
-                if loss is None:
-                    loss = example_loss
-                else:
-                    loss += example_loss
-            loss = loss / minibatch_size
-            loss.backward()
-            optimizer.step()
-            predicted_label = torch.argmax(predicted_vector)
-            if predicted_label != gold_label:
-                error_samples_train.append((" ".join(original_text), gold_label, predicted_label.item()))
+        error_sink.start(epoch + 1, "train")
+        for indices, input_batch, gold_labels in profiler.fetch(tqdm(train_loader)):
+            with profiler.phase("forward"):
+                optimizer.zero_grad()
+                predicted_vectors = model(input_batch)
+            predicted_labels = torch.argmax(predicted_vectors, dim=1)
+            correct += int((predicted_labels == gold_labels).sum())
+            total += len(gold_labels)
+            with profiler.phase("loss"):
+                loss = model.compute_Loss(predicted_vectors, gold_labels) # mean over the minibatch
+            with profiler.phase("backward"):
+                loss.backward()
+            with profiler.phase("optimizer"):
+                optimizer.step()
+            profiler.count(len(gold_labels), int(input_batch.values().sum()))
+            error_sink.add("train", indices, predicted_labels, gold_labels, predicted_vectors)
+            step += 1
+            if args.eval_every > 0 and step % args.eval_every == 0:
+                with profiler.phase("evaluation"):
+                    step_accuracies.append({"epoch": epoch + 1, "step": step, "accuracy": evaluate(model, valid_loader)})
+                tqdm.write("Validation accuracy at step {}: {}".format(step, step_accuracies[-1]["accuracy"]))
 
         train_time = time.time() - start_time # time taken for training
+        error_sink.end("train")
         train_acc = correct / total # accuracy on training set
         train_accuracies.append(train_acc)
         train_times.append(train_time)
@@ -179,48 +286,64 @@ if __name__ == "__main__":
         print("Training time for this epoch: {}".format(train_time))
 
 
-        loss = None
-        correct = 0
-        total = 0
         start_time = time.time()
         print("Validation started for epoch {}".format(epoch + 1))
-        minibatch_size = 16 
-        N = len(valid_data) 
-        for minibatch_index in tqdm(range(N // minibatch_size)):
-            optimizer.zero_grad()
-            loss = None
-            for example_index in range(minibatch_size):
-                original_text, input_vector, gold_label = valid_data[minibatch_index * minibatch_size + example_index]
-                predicted_vector = model(input_vector)
-                predicted_label = torch.argmax(predicted_vector)
-                correct += int(predicted_label == gold_label)
-                total += 1
-                example_loss = model.compute_Loss(predicted_vector.view(1,-1), torch.tensor([gold_label]))
-                if loss is None:
-                    loss = example_loss
-                else:
-                    loss += example_loss
-            loss = loss / minibatch_size
-            predicted_label = torch.argmax(predicted_vector)
-            if predicted_label != gold_label:
-                error_samples_val.append((" ".join(original_text), gold_label, predicted_label.item()))
+        error_sink.start(epoch + 1, "validation")
+        with profiler.phase("evaluation"):
+            val_acc = evaluate(model, valid_loader, partial(error_sink.add, "validation")) # accuracy on validation set
+        error_sink.end("validation")
         val_time = time.time() - start_time # time taken for validation
-        val_acc = correct / total # accuracy on validation set
         val_accuracies.append(val_acc)
         val_times.append(val_time) 
         print("Validation completed for epoch {}".format(epoch + 1))
         print("Validation accuracy for epoch {}: {}".format(epoch + 1, val_acc))
         print("Validation time for this epoch: {}".format(val_time))
+        print_profile(profiler.end_epoch(epoch + 1))
+
+        history = {"train_accuracies": train_accuracies, "train_times": train_times,
+                   "val_accuracies": val_accuracies, "val_times": val_times, "step_accuracies": step_accuracies}
+        if val_acc > best_val_acc:
+            best_val_acc = val_acc
+            save_checkpoint(best_checkpoint, "ffnn", model, model_config, vocab_list, optimizer, epoch + 1, history)
+        if args.checkpoint_every > 0 and ((epoch + 1) % args.checkpoint_every == 0 or epoch + 1 == args.epochs):
+            save_checkpoint(last_checkpoint, "ffnn", model, model_config, vocab_list, optimizer, epoch + 1, history)
+
+    if args.save_model is not None:
+        save_model(args.save_model, "ffnn", model, model_config, vocab=vocab_list)
 
-    # Write results to error_samples_ffnn.txt
+    if args.test_data != "to fill":
+        print("========== Scoring {} ==========".format(args.test_data))
+        if args.hash_buckets is not None:
+            convert = partial(convert_to_hashed_ids, buckets=args.hash_buckets, bigrams=args.bigrams)
+        else:
+            convert = partial(convert_to_ids, word2index=dict(zip(index2word, range(vocab_size))))
+        test_stats = predict(model, convert, collate_fn, args.test_data, "results/predictions_ffnn.jsonl")
+        print_stats(test_stats)
+
+    # Write the error samples of the last epoch to error_samples_ffnn.txt
+    error_sink.close()
+    # The ids have lost case, rare words (<UNK>) or, hashed, the words themselves: the few sampled texts
+    # are read back from the data files (those preprocess.py recorded with --data_dir). Without the file,
+    # or when it has changed since preprocessing, a sample is given by its document index.
+    splits = [("Training", "train", "train"), ("Validation", "validation", "valid")]
     with open("error-samples/error_samples_ffnn.txt", "w") as f:
-        f.write("Training Errors:\n")
-        for vec, gold, pred in error_samples_train[:10]:  # just first 10 for brevity
-            f.write(f"Text: {vec}\nGold: {gold}, Pred: {pred}\n\n")
+        for title, split, source in splits:
+            if split not in error_sink.last:
+                continue
+            record = error_sink.last[split]
+            path, digest = sources[source]
+            texts = read_texts(path, [sample["index"] for sample in record["samples"]], digest)
+            f.write("{} Errors (epoch {}, {} of {} documents):\n".format(title, record["epoch"], record["errors"], record["documents"]))
+            f.write(format_confusion(record["confusion"]) + "\n")
+            for sample in record["samples"]:
+                if sample["index"] in texts:
+                    f.write("Text: {}\n".format(texts[sample["index"]]))
+                else:
+                    f.write("Document: {}\n".format(sample["index"]))
+                f.write("Gold: {}, Pred: {}\n\n".format(sample["gold"], sample["predicted"]))
+            f.write("\n")
 
-        f.write("\nValidation Errors:\n")
-        for vec, gold, pred in error_samples_val[:10]:
-            f.write(f"Text: {vec}\nGold: {gold}, Pred: {pred}\n\n")
+    profiler.write("results/profile_ffnn", vars(args))
 
     # Write results to test_ffnn.out
     print("========== Writing results to test_ffnn.out ==========")
@@ -228,10 +351,24 @@ if __name__ == "__main__":
         f.write("Training Results:\n")
         f.write("Number of epochs: {}\n".format(args.epochs))
         f.write("Hidden dimension: {}\n".format(args.hidden_dim))
-        f.write("Training data: {}\n".format(args.train_data))
-        f.write("Validation data: {}\n".format(args.val_data))
+        if args.hash_buckets is not None:
+            f.write("Hash buckets: {}{}\n".format(vocab_size, " (words and bigrams)" if args.bigrams else ""))
+        else:
+            f.write("Vocabulary size: {}\n".format(vocab_size))
+        if args.data_dir is not None:
+            f.write("Preprocessed data: {}\n".format(args.data_dir))
+        else:
+            f.write("Training data: {}\n".format(args.train_data))
+            f.write("Validation data: {}\n".format(args.val_data))
         if args.test_data != "to fill":
             f.write("Test data: {}\n".format(args.test_data))
+            write_stats(f, test_stats)
+        if args.eval_subsample is not None:
+            f.write("Validation subsample: {} documents\n".format(args.eval_subsample))
+        if step_accuracies:
+            f.write("\nValidation accuracy every {} steps:\n".format(args.eval_every))
+            for record in step_accuracies:
+                f.write("Epoch {epoch}, step {step}: {accuracy}\n".format(**record))
         f.write("\nPer-epoch Results:\n")
         for epoch in range(args.epochs):
             f.write("\nEpoch {}:\n".format(epoch + 1))
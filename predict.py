@@ -0,0 +1,113 @@
+import json
+import os
+import time
+from argparse import ArgumentParser
+from functools import partial
+from itertools import islice
+
+import numpy as np
+import torch
+
+from checkpoint import load_model
+from data_utils import stream_data, DocumentDataset
+
+
+# Returns:
+# convert = A function turning (document, y) pairs into flatten_documents arrays for the saved model
+# collate_fn = The collate function of the saved model
+def make_pipeline(checkpoint):
+    if checkpoint["model"] == "ffnn":
+        from ffnn import convert_to_ids, convert_to_hashed_ids, collate_bag_of_words
+        config = checkpoint["config"]
+        collate_fn = partial(collate_bag_of_words, vocab_size=config["input_dim"])
+        if config.get("hash_buckets") is not None:
+            return partial(convert_to_hashed_ids, buckets=config["hash_buckets"], bigrams=config["bigrams"]), collate_fn
+        word2index = {word: index for index, word in enumerate(checkpoint["vocab"])}
+        return partial(convert_to_ids, word2index=word2index), collate_fn
+    from rnn import convert_to_ids, collate_padded
+    from embedding import load_vocab
+    word2id = {word: index for index, word in enumerate(load_vocab(checkpoint["config"]["embedding"]))}
+    return partial(convert_to_ids, word2id=word2id), collate_padded
+
+
+# Scores data_path with model in minibatches of batch_size documents. The file is streamed, so only one
+# minibatch of text is in memory at a time. Each document gets one JSON line in output_path:
+#   {"index": i, "stars": predicted stars, "probabilities": [p(1 star), ..., p(5 stars)]}
+# plus "gold" (the true stars) when the file has them.
+# Returns:
+# stats = A dict with the number of documents, docs/sec, p50/p99 per-minibatch latency in ms (vectorizing
+#         and forward pass) and the accuracy over the labelled documents (None without labels)
+def predict(model, convert, collate_fn, data_path, output_path, batch_size=1024):
+    model.eval()
+    documents = stream_data(data_path)
+    latencies = []
+    total = 0
+    labelled = 0
+    correct = 0
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    start_time = time.time()
+    with open(output_path, "w") as f, torch.inference_mode():
+        while True:
+            batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+            batch_start = time.perf_counter()
+            dataset = DocumentDataset(*convert(batch))
+            _, inputs, gold_labels = collate_fn([dataset[index] for index in range(len(dataset))])
+            probabilities = torch.exp(model(inputs))
+            predicted_labels = torch.argmax(probabilities, dim=1)
+            latencies.append(time.perf_counter() - batch_start)
+
+            has_label = gold_labels >= 0
+            labelled += int(has_label.sum())
+            correct += int((predicted_labels == gold_labels)[has_label].sum())
+            for offset, (predicted_label, gold_label, row) in enumerate(
+                    zip(predicted_labels.tolist(), gold_labels.tolist(), probabilities.tolist())):
+                record = {"index": total + offset, "stars": predicted_label + 1,
+                          "probabilities": [round(p, 6) for p in row]}
+                if gold_label >= 0:
+                    record["gold"] = gold_label + 1
+                f.write(json.dumps(record) + "\n")
+            total += len(batch)
+    elapsed = time.time() - start_time
+
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {"documents": total, "docs_per_sec": total / elapsed if elapsed > 0 else 0.0,
+            "p50_batch_ms": float(np.percentile(latencies_ms, 50)),
+            "p99_batch_ms": float(np.percentile(latencies_ms, 99)),
+            "accuracy": correct / labelled if labelled else None}
+
+
+def print_stats(stats):
+    print("Scored {} documents at {:.1f} docs/sec".format(stats["documents"], stats["docs_per_sec"]))
+    print("Per-batch latency: p50 {:.2f} ms, p99 {:.2f} ms".format(stats["p50_batch_ms"], stats["p99_batch_ms"]))
+    if stats["accuracy"] is not None:
+        print("Accuracy: {}".format(stats["accuracy"]))
+
+
+# Appends the stats to an open results file
+def write_stats(f, stats):
+    f.write("Test documents: {}\n".format(stats["documents"]))
+    f.write("Test throughput (docs/sec): {}\n".format(stats["docs_per_sec"]))
+    f.write("Test batch latency p50/p99 (ms): {} / {}\n".format(stats["p50_batch_ms"], stats["p99_batch_ms"]))
+    if stats["accuracy"] is not None:
+        f.write("Test accuracy: {}\n".format(stats["accuracy"]))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint", required = True, help = "model saved by ffnn.py/rnn.py --save_model")
+    parser.add_argument("--test_data", required = True, help = "path to the data to score")
+    parser.add_argument("--output", default = None, help = "predictions file (default: results/predictions_<model>.jsonl)")
+    parser.add_argument("-b", "--batch_size", type=int, default = 1024, help = "documents per minibatch")
+    args = parser.parse_args()
+
+    model, checkpoint = load_model(args.checkpoint)
+    convert, collate_fn = make_pipeline(checkpoint)
+    output = args.output or "results/predictions_{}.jsonl".format(checkpoint["model"])
+    print("========== Scoring {} ==========".format(args.test_data))
+    stats = predict(model, convert, collate_fn, args.test_data, output, args.batch_size)
+    print_stats(stats)
+    print("Predictions written to {}".format(output))
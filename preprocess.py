@@ -0,0 +1,99 @@
+import json
+import os
+from argparse import ArgumentParser
+
+from data_utils import stream_data, save_arrays, load_arrays, save_words, file_digest
+
+
+# A preprocessed dataset is a directory holding
+#   train/, valid/ (and test/) = ids.npy, offsets.npy and labels.npy of each split (see flatten_documents)
+#   vocab.txt                  = The vocabulary the ids refer to, one word per line
+#   meta.json                  = The model the ids were made for: for the FFNN its vocabulary cutoffs or hash
+#                                buckets, for the RNN its embedding directory and the vocab_digest of its
+#                                vocabulary; and under "sources" the absolute path and file_digest of the
+#                                data file of each split, to read texts back from
+# The trainers memory-map the arrays, so a run on a preprocessed dataset starts in the same time
+# whatever the size of the corpus.
+VOCAB_FILE = "vocab.txt"
+META_FILE = "meta.json"
+ARRAYS = ["ids", "offsets", "labels"]
+
+
+# Converts every file of data_paths ({split: path to a JSON data file}) for model and writes the
+# dataset to out_dir. The FFNN vocabulary is built from the "train" split (with the min_freq and
+# max_vocab cutoffs of ffnn.make_vocab), unless hash_buckets is given: the ids are then hashed
+# features and there is no vocab.txt. The RNN uses the vocabulary of its word embedding.
+def preprocess(model, out_dir, data_paths, embedding="./word_embedding.pkl", min_freq=1, max_vocab=None,
+               hash_buckets=None, bigrams=False):
+    words = None
+    if model == "ffnn" and hash_buckets is not None:
+        import ffnn
+        convert = lambda data: ffnn.convert_to_hashed_ids(data, hash_buckets, bigrams)
+        meta = {"model": model, "hash_buckets": hash_buckets, "bigrams": bigrams}
+    elif model == "ffnn":
+        import ffnn
+        word2index, words = ffnn.make_indices(ffnn.make_vocab(stream_data(data_paths["train"]), min_freq, max_vocab))
+        convert = lambda data: ffnn.convert_to_ids(data, word2index)
+        meta = {"model": model, "min_freq": min_freq, "max_vocab": max_vocab}
+    else:
+        import rnn
+        from embedding import embedding_directory, load_vocab, vocab_digest
+        embedding_dir = embedding_directory(embedding)
+        words = load_vocab(embedding_dir)
+        word2id = {word: index for index, word in enumerate(words)}
+        convert = lambda data: rnn.convert_to_ids(data, word2id)
+        meta = {"model": model, "embedding": os.path.abspath(embedding_dir), "vocab_digest": vocab_digest(embedding_dir)}
+
+    meta["sources"] = {split: {"path": os.path.abspath(path), "digest": file_digest(path)}
+                       for split, path in data_paths.items()}
+    os.makedirs(out_dir, exist_ok=True)
+    for split, path in data_paths.items():
+        print("Converting {} to {}".format(path, os.path.join(out_dir, split)))
+        save_arrays(os.path.join(out_dir, split), **dict(zip(ARRAYS, convert(stream_data(path)))))
+    if words is not None:
+        save_words(os.path.join(out_dir, VOCAB_FILE), words)
+    with open(os.path.join(out_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+# Returns:
+# ids, offsets, labels = The arrays of split, memory-mapped read-only
+def load_split(data_dir, split):
+    return load_arrays(os.path.join(data_dir, split), ARRAYS, mmap=True)
+
+
+def load_meta(data_dir):
+    with open(os.path.join(data_dir, META_FILE)) as f:
+        return json.load(f)
+
+
+# Returns:
+# path, digest = The data file split was converted from and its file_digest at the time (the arguments
+#                of read_texts); None, None for a dataset without them
+def split_source(meta, split):
+    source = meta.get("sources", {}).get(split)
+    if not isinstance(source, dict):
+        # datasets written before the digests recorded a bare path, which may no longer hold the same reviews
+        return None, None
+    return source["path"], source["digest"]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", choices = ["ffnn", "rnn"], required = True, help = "model the ids are made for")
+    parser.add_argument("--train_data", required = True, help = "path to training data")
+    parser.add_argument("--val_data", required = True, help = "path to validation data")
+    parser.add_argument("--test_data", default = None, help = "path to test data")
+    parser.add_argument("--embedding", default = "./word_embedding.pkl", help = "word embedding of the RNN")
+    parser.add_argument("--min_freq", type=int, default = 1, help = "FFNN: minimum training count of a vocabulary word")
+    parser.add_argument("--max_vocab", type=int, default = None, help = "FFNN: keep only this many most frequent words")
+    parser.add_argument("--hash_buckets", type=int, default = None, help = "FFNN: hash words into this many features instead")
+    parser.add_argument("--bigrams", action='store_true', help = "FFNN: with --hash_buckets, also hash adjacent word pairs")
+    parser.add_argument("--out_dir", required = True, help = "directory to write the dataset to")
+    args = parser.parse_args()
+
+    data_paths = {"train": args.train_data, "valid": args.val_data}
+    if args.test_data is not None:
+        data_paths["test"] = args.test_data
+    preprocess(args.model, args.out_dir, data_paths, args.embedding, args.min_freq, args.max_vocab,
+               args.hash_buckets, args.bigrams)
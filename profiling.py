@@ -0,0 +1,118 @@
+import csv
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+from torch.profiler import profile, record_function, schedule, ProfilerActivity
+
+
+PHASES = ["fetch", "forward", "loss", "backward", "optimizer", "evaluation"]
+
+
+# Returns:
+# rss = The peak resident set size of this process so far, in MB
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+# Accumulates the wall time of each phase of the training steps (PHASES: fetching/collating a
+# minibatch, forward pass, loss, backward pass, optimizer step, and the whole validation pass) with
+# the examples and tokens processed, one record per epoch:
+#   {"epoch", "<phase>_sec" for each phase, "train_sec", "examples", "tokens",
+#    "examples_per_sec", "tokens_per_sec", "peak_rss_mb"}
+# train_sec is the wall time of the training steps; examples/tokens per second are taken over it.
+# With a trace_path, torch.profiler also records training steps 3 to trace_steps + 2 (each count()
+# ends a step), with every phase labelled, and writes them to trace_path as a Chrome trace.
+class PhaseProfiler:
+    def __init__(self, trace_path=None, trace_steps=10):
+        self.records = []
+        self.trace = None
+        if trace_path is not None:
+            directory = os.path.dirname(trace_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.trace = profile(activities=[ProfilerActivity.CPU],
+                                 schedule=schedule(wait=1, warmup=1, active=trace_steps, repeat=1),
+                                 on_trace_ready=lambda prof: prof.export_chrome_trace(trace_path))
+            self.trace.start()
+        self.start_epoch()
+
+    def start_epoch(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.examples = 0
+        self.tokens = 0
+        self.epoch_start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        label = record_function(name) if self.trace is not None else nullcontext()
+        start = time.perf_counter()
+        with label:
+            yield
+        self.seconds[name] += time.perf_counter() - start
+
+    # Yields the minibatches of loader, timing each fetch as the "fetch" phase
+    def fetch(self, loader):
+        iterator = iter(loader)
+        while True:
+            with self.phase("fetch"):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    # Ends a training step of examples documents holding tokens words
+    def count(self, examples, tokens):
+        self.examples += examples
+        self.tokens += tokens
+        if self.trace is not None:
+            self.trace.step()
+
+    # Closes the epoch's record; the time spent after it (validation) is excluded from train_sec
+    def end_epoch(self, epoch):
+        train_sec = time.perf_counter() - self.epoch_start - self.seconds["evaluation"]
+        record = {"epoch": epoch}
+        for name in PHASES:
+            record[name + "_sec"] = self.seconds[name]
+        record.update({"train_sec": train_sec, "examples": self.examples, "tokens": self.tokens,
+                       "examples_per_sec": self.examples / train_sec if train_sec > 0 else 0.0,
+                       "tokens_per_sec": self.tokens / train_sec if train_sec > 0 else 0.0,
+                       "peak_rss_mb": peak_rss_mb()})
+        self.records.append(record)
+        self.start_epoch()
+        return record
+
+    # Stops the torch.profiler trace (if any) and writes the epoch records to <prefix>.json and <prefix>.csv
+    def write(self, prefix, metadata):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(prefix + ".json", "w") as f:
+            json.dump({"metadata": metadata, "epochs": self.records}, f, indent=2)
+        if self.records:
+            with open(prefix + ".csv", "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(self.records[0]))
+                writer.writeheader()
+                writer.writerows(self.records)
+
+
+def print_profile(record):
+    phases = ", ".join("{} {:.3f}s".format(name, record[name + "_sec"]) for name in PHASES)
+    print("Phases for epoch {}: {}".format(record["epoch"], phases))
+    print("Throughput for epoch {}: {:.1f} examples/sec, {:.1f} tokens/sec, peak RSS {:.1f} MB".format(
+        record["epoch"], record["examples_per_sec"], record["tokens_per_sec"], record["peak_rss_mb"]))
+
+
+# Adds the profiling options to an ArgumentParser
+def add_profile_arguments(parser):
+    parser.add_argument("--torch_profile", action='store_true',
+                        help = "also write a torch.profiler Chrome trace of the first training steps to results/")
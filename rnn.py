@@ -8,18 +8,33 @@ import random
 import os
 import time
 from tqdm import tqdm
-import json
 import string
 from argparse import ArgumentParser
-import pickle
+from functools import partial
+import hashlib
+from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, PackedSequence
+from data_utils import BucketBatchSampler, stream_data, read_texts, flatten_documents, file_digest, save_arrays, load_arrays
+from data_utils import DocumentDataset, make_loader, add_loader_arguments
+from preprocess import load_split, load_meta, split_source, ARRAYS
+from embedding import embedding_directory, load_vocab, load_matrix, vocab_digest, check_vocab
+from checkpoint import save_model, save_checkpoint, load_checkpoint, load_weights, add_checkpoint_arguments
+from predict import predict, print_stats, write_stats
+from profiling import PhaseProfiler, print_profile, add_profile_arguments
+from evaluate import make_eval_loader, evaluate, add_eval_arguments
+from errors import ErrorSink, format_confusion, add_error_arguments
 
 unk = '<UNK>'
 # Consult the PyTorch documentation for information on the functions used below:
 # https://pytorch.org/docs/stable/torch.html
 class RNN(nn.Module):
-    def __init__(self, input_dim, h):  # Add relevant parameters
+    # With an embedding matrix, forward takes word ids and looks them up in an nn.Embedding that is
+    # frozen unless fine_tune is set; input_dim must then equal the embedding dimension.
+    def __init__(self, input_dim, h, embedding=None, fine_tune=False):  # Add relevant parameters
         super(RNN, self).__init__()
         self.h = h
+        self.embedding = None
+        if embedding is not None:
+            self.embedding = nn.Embedding.from_pretrained(embedding, freeze=not fine_tune)
         self.numOfLayer = 1
         self.rnn = nn.RNN(input_dim, h, self.numOfLayer, nonlinearity='tanh')
         self.W = nn.Linear(h, 5)
@@ -30,45 +45,118 @@ class RNN(nn.Module):
         return self.loss(predicted_vector, gold_label)
 
     def forward(self, inputs):
+        # inputs is a padded (T, B, input_dim) tensor or a PackedSequence; with a PackedSequence
+        # the final hidden state of each document is taken at its own length, not at the padding.
+        # With an embedding, inputs hold word ids instead and only the packed ids are looked up.
+        if self.embedding is not None:
+            if isinstance(inputs, PackedSequence):
+                inputs = inputs._replace(data=self.embedding(inputs.data))
+            else:
+                inputs = self.embedding(inputs)
         # [to fill] obtain hidden layer representation (https://pytorch.org/docs/stable/generated/torch.nn.RNN.html)
         _, hidden = self.rnn(inputs)  
         # [to fill] obtain output layer representations
-        output_layer = self.W(hidden[-1])  # Using only the last hidden state for classification
+        output_layer = self.W(hidden[-1])  # Using only the last hidden state for classification; (B, 5)
         # [to fill] sum over output 
-        summed_output = torch.sum(output_layer, dim=0, keepdim=True)
+        # (nothing left to sum: each row of output_layer already belongs to one document of the batch)
         # [to fill] obtain probability dist.
-        predicted_vector = self.softmax(summed_output)
+        predicted_vector = self.softmax(output_layer)
 
         return predicted_vector
 
 
-def load_data(train_data, val_data):
-    with open(train_data) as training_f:
-        training = json.load(training_f)
-    with open(val_data) as valid_f:
-        validation = json.load(valid_f)
-
-    tra = []
-    val = []
-    for elt in training:
-        tra.append((elt["text"].split(),int(elt["stars"]-1)))
-    for elt in validation:
-        val.append((elt["text"].split(),int(elt["stars"]-1)))
-    return tra, val
+# Returns:
+# input_words = The words of the document with punctuation removed
+def tokenize(input_words):
+    input_words = " ".join(input_words)
+
+    # Remove punctuation
+    return input_words.translate(input_words.maketrans("", "", string.punctuation)).split()
+
+
+# Converts data, any iterable of (document, y) pairs such as a stream_data generator.
+# Returns:
+# ids = A flat int32 array with the embedding row of every word of every document
+#       (punctuation removed, lowercased, unknown words mapped to 'unk', an empty document read as one 'unk')
+# offsets = An int64 array of length N + 1; document i is ids[offsets[i]:offsets[i + 1]]
+# labels = An int64 array with the N labels
+def convert_to_ids(data, word2id):
+    unk_id = word2id['unk']
+    return flatten_documents(([word2id.get(word.lower(), unk_id) for word in tokenize(input_words)] or [unk_id], gold_label)
+                             for input_words, gold_label in data)
+
+
+# Returns:
+# ids, offsets, labels = The convert_to_ids arrays of the data file against the embedding vocabulary words.
+#                        They are cached under cache_dir, keyed by the content hashes of the data file and of
+#                        the vocabulary, so a rerun on the same files reads them back without any text processing.
+def load_token_ids(data_path, words, vocab_digest, cache_dir):
+    key = hashlib.sha1((file_digest(data_path) + vocab_digest).encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, "rnn-" + key)
+    if os.path.isdir(cache_path):
+        return load_arrays(cache_path, ARRAYS, mmap=True)
+    word2id = {word: index for index, word in enumerate(words)}
+    ids, offsets, labels = convert_to_ids(stream_data(data_path), word2id)
+    save_arrays(cache_path, ids=ids, offsets=offsets, labels=labels)
+    return ids, offsets, labels
+
+
+# Collates DocumentDataset items into a padded minibatch.
+# Returns:
+# indices = A (B,) long tensor with the dataset index of each document
+# inputs = A PackedSequence of the (T, B) padded word ids of the documents
+# gold_labels = A (B,) long tensor of labels
+def collate_padded(examples):
+    indices, documents, labels = zip(*examples)
+    sequences = [torch.from_numpy(document.astype(np.int64)) for document in documents]
+    lengths = torch.tensor([len(sequence) for sequence in sequences])
+    inputs = pack_padded_sequence(pad_sequence(sequences), lengths, enforce_sorted=False)
+    return torch.tensor(indices), inputs, torch.tensor(labels)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-hd", "--hidden_dim", type=int, required = True, help = "hidden_dim")
     parser.add_argument("-e", "--epochs", type=int, required = True, help = "num of epochs to train")
-    parser.add_argument("--train_data", required = True, help = "path to training data")
-    parser.add_argument("--val_data", required = True, help = "path to validation data")
+    parser.add_argument("--train_data", default = None, help = "path to training data")
+    parser.add_argument("--val_data", default = None, help = "path to validation data")
+    parser.add_argument("--data_dir", default = None,
+                        help = "dataset written by preprocess.py, used instead of --train_data/--val_data/--embedding")
     parser.add_argument("--test_data", default = "to fill", help = "path to test data")
-    parser.add_argument('--do_train', action='store_true')
+    parser.add_argument("-b", "--batch_size", type=int, default = 16, help = "minibatch size")
+    parser.add_argument("--bucket_width", type=int, default = 10,
+                        help = "group training documents into length buckets this many tokens wide (0 = plain shuffle)")
+    parser.add_argument("--embedding", default = "./word_embedding.pkl",
+                        help = "converted embedding directory, or a pickled embedding to convert on first use")
+    parser.add_argument("--fine_tune_embedding", action='store_true', help = "train the embedding along with the RNN")
+    parser.add_argument("--cache_dir", default = "./cache", help = "directory for cached token ids")
+    add_loader_arguments(parser)
+    add_eval_arguments(parser)
+    add_error_arguments(parser)
+    parser.add_argument("--save_model", default = None, help = "path to save the trained model to (for predict.py)")
+    add_checkpoint_arguments(parser, "rnn")
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.data_dir is None and (args.train_data is None or args.val_data is None):
+        parser.error("either --data_dir or both --train_data and --val_data are required")
+
+    # fix random seeds; the bucketing sampler shuffles with the random module
+    random.seed(42)
+    torch.manual_seed(42)
 
     print("========== Loading data ==========")
-    train_data, valid_data = load_data(args.train_data, args.val_data) # X_data is a list of pairs (document, y); y in {0,1,2,3,4}
+    if args.data_dir is not None:
+        meta = load_meta(args.data_dir)
+        if meta["model"] != "rnn":
+            parser.error("{} was preprocessed for another model".format(args.data_dir))
+        embedding_dir = meta["embedding"]
+        # the ids are rows of the embedding as it was converted when the dataset was written
+        check_vocab(embedding_dir, meta.get("vocab_digest"), args.data_dir)
+    else:
+        embedding_dir = embedding_directory(args.embedding)
+    words = load_vocab(embedding_dir)
+    words_digest = vocab_digest(embedding_dir)
+    embedding_matrix = load_matrix(embedding_dir, fine_tune=args.fine_tune_embedding) # memory-mapped unless fine-tuned
 
     # Think about the type of function that an RNN describes. To apply it, you will need to convert the text data into vector representations.
     # Further, think about where the vectors will come from. There are 3 reasonable choices:
@@ -78,10 +166,31 @@ if __name__ == "__main__":
     # Option 3 will be the most time consuming, so we do not recommend starting with this
 
     print("========== Vectorizing data ==========")
-    model = RNN(50, args.hidden_dim)  # Fill in parameters
+    # Each document becomes a run of embedding rows, done once and cached on disk
+    if args.data_dir is not None:
+        # memory-mapped arrays written by preprocess.py: nothing is parsed, hashed or tokenized
+        train_ids, train_offsets, train_labels = load_split(args.data_dir, "train")
+        valid_ids, valid_offsets, valid_labels = load_split(args.data_dir, "valid")
+    else:
+        train_ids, train_offsets, train_labels = load_token_ids(args.train_data, words, words_digest, args.cache_dir)
+        valid_ids, valid_offsets, valid_labels = load_token_ids(args.val_data, words, words_digest, args.cache_dir)
+
+    model_config = {"hidden_dim": args.hidden_dim, "embedding": os.path.abspath(embedding_dir),
+                    "vocab_digest": words_digest, "fine_tune_embedding": args.fine_tune_embedding}
+    model = RNN(embedding_matrix.shape[1], args.hidden_dim, embedding_matrix, fine_tune=args.fine_tune_embedding)  # Fill in parameters
     # optimizer = optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
     optimizer = optim.Adam(model.parameters(), lr=0.01)
-    word_embedding = pickle.load(open('./word_embedding.pkl', 'rb'))
+
+    train_dataset = DocumentDataset(train_ids, train_offsets, train_labels)
+    valid_dataset = DocumentDataset(valid_ids, valid_offsets, valid_labels)
+    # the samplers choose minibatches from the timesteps each document will take
+    train_sampler = BucketBatchSampler(train_dataset.lengths(), args.batch_size, args.bucket_width)
+    loader_options = {"num_workers": args.num_workers, "pin_memory": args.pin_memory,
+                      "prefetch_factor": args.prefetch_factor}
+    train_loader = make_loader(train_dataset, collate_padded, batch_sampler=train_sampler, **loader_options)
+    # validation covers every document (or --eval_subsample of them) in minibatches of --eval_batch_size
+    valid_loader = make_eval_loader(valid_dataset, collate_padded, args.eval_batch_size, args.eval_subsample,
+                                    seed=42, **loader_options)
 
     stopping_condition = False
     epoch = 0
@@ -92,97 +201,86 @@ if __name__ == "__main__":
     # At the start of training, initialize lists to track metrics
     train_accuracies = []
     val_accuracies = []
-
-    error_examples = [] # List to store error examples
-
+    padding_efficiencies = []
+    step_accuracies = [] # {"epoch", "step", "accuracy"} of the --eval_every evaluations
+
+    last_checkpoint = os.path.join(args.checkpoint_dir, "last.pt")
+    best_checkpoint = os.path.join(args.checkpoint_dir, "best.pt")
+    if args.resume and os.path.isfile(last_checkpoint):
+        checkpoint = load_checkpoint(last_checkpoint, model, optimizer, model_config)
+        epoch = checkpoint["epoch"]
+        history = checkpoint["history"]
+        train_accuracies, val_accuracies, padding_efficiencies = (history[key] for key in
+            ["train_accuracies", "val_accuracies", "padding_efficiencies"])
+        last_train_accuracy, last_validation_accuracy, stopping_condition = (history[key] for key in
+            ["last_train_accuracy", "last_validation_accuracy", "stopping_condition"])
+        step_accuracies = history.get("step_accuracies", [])
+        print("========== Resuming from {} after epoch {} ==========".format(last_checkpoint, epoch))
+    best_validation_accuracy = max(val_accuracies, default=-1)
+    profiler = PhaseProfiler(trace_path="results/trace_rnn.json" if args.torch_profile else None)
+
+    # a bounded sample of the misclassified validation documents (their ids) and the confusion
+    # matrix, streamed to disk every epoch
+    error_sink = ErrorSink("error-samples/errors_rnn.jsonl", args.error_samples, args.error_selection,
+                           append=args.resume and epoch > 0)
+
+    step = epoch * len(train_loader)
     while not stopping_condition:
-        random.shuffle(train_data)
+        profiler.start_epoch()
         model.train()
         # You will need further code to operationalize training, ffnn.py may be helpful
         print("Training started for epoch {}".format(epoch + 1))
-        train_data = train_data
         correct = 0
         total = 0
-        minibatch_size = 16
-        N = len(train_data)
 
         loss_total = 0
         loss_count = 0
-        for minibatch_index in tqdm(range(N // minibatch_size)):
-            optimizer.zero_grad()
-            loss = None
-            for example_index in range(minibatch_size):
-                input_words, gold_label = train_data[minibatch_index * minibatch_size + example_index]
-                input_words = " ".join(input_words)
-
-                # Remove punctuation
-                input_words = input_words.translate(input_words.maketrans("", "", string.punctuation)).split()
-
-                # Look up word embedding dictionary
-                vectors = [word_embedding[i.lower()] if i.lower() in word_embedding.keys() else word_embedding['unk'] for i in input_words ]
-
-                # Transform the input into required shape
-                vectors = torch.tensor(vectors).view(len(vectors), 1, -1)
-                output = model(vectors)
-
-                # Get loss
-                example_loss = model.compute_Loss(output.view(1,-1), torch.tensor([gold_label]))
-
-                # Get predicted label
-                predicted_label = torch.argmax(output)
-
-                correct += int(predicted_label == gold_label)
-                # print(predicted_label, gold_label)
-                total += 1
-                if loss is None:
-                    loss = example_loss
-                else:
-                    loss += example_loss
+        # the sampler reshuffles every epoch and keeps documents of similar length together
+        for indices, inputs, gold_labels in profiler.fetch(tqdm(train_loader)):
+            with profiler.phase("forward"):
+                optimizer.zero_grad()
+                output = model(inputs)
+
+            # Get loss, averaged over the minibatch
+            with profiler.phase("loss"):
+                loss = model.compute_Loss(output, gold_labels)
+
+            # Get predicted label
+            predicted_labels = torch.argmax(output, dim=1)
+
+            correct += int((predicted_labels == gold_labels).sum())
+            total += len(gold_labels)
 
-            loss = loss / minibatch_size
             loss_total += loss.data
             loss_count += 1
-            loss.backward()
-            optimizer.step()
+            with profiler.phase("backward"):
+                loss.backward()
+            with profiler.phase("optimizer"):
+                optimizer.step()
+            profiler.count(len(gold_labels), len(inputs.data))
+            step += 1
+            if args.eval_every > 0 and step % args.eval_every == 0:
+                with profiler.phase("evaluation"):
+                    step_accuracies.append({"epoch": epoch + 1, "step": step, "accuracy": evaluate(model, valid_loader)})
+                tqdm.write("Validation accuracy at step {}: {}".format(step, step_accuracies[-1]["accuracy"]))
         print(loss_total/loss_count)
         print("Training completed for epoch {}".format(epoch + 1))
         train_accuracies.append(correct / total)
         print("Training accuracy for epoch {}: {}".format(epoch + 1, train_accuracies[-1]))
+        padding_efficiencies.append(train_sampler.padding_efficiency())
+        print("Padding efficiency for epoch {}: {:.4f}".format(epoch + 1, padding_efficiencies[-1]))
         trainning_accuracy = correct/total
 
 
-        model.eval()
-        correct = 0
-        total = 0
-        random.shuffle(valid_data)
         print("Validation started for epoch {}".format(epoch + 1))
-        valid_data = valid_data
-
-        for input_words, gold_label in tqdm(valid_data):
-            input_words = " ".join(input_words)
-            input_words = input_words.translate(input_words.maketrans("", "", string.punctuation)).split()
-            vectors = [word_embedding[i.lower()] if i.lower() in word_embedding.keys() else word_embedding['unk'] for i
-                       in input_words]
-
-            vectors = torch.tensor(vectors).view(len(vectors), 1, -1)
-            output = model(vectors)
-            predicted_label = torch.argmax(output)
-            correct += int(predicted_label == gold_label)
-            total += 1
-            # code to write error examples to a file
-            predicted_label = torch.argmax(output)
-
-            if predicted_label != gold_label:
-                error_examples.append({
-                    "input": " ".join(input_words),
-                    "gold": gold_label,
-                    "predicted": predicted_label.item()
-                })
-            # print(predicted_label, gold_label)
+        error_sink.start(epoch + 1, "validation")
+        with profiler.phase("evaluation"):
+            validation_accuracy = evaluate(model, valid_loader, partial(error_sink.add, "validation"))
+        error_sink.end("validation")
         print("Validation completed for epoch {}".format(epoch + 1))
-        val_accuracies.append(correct / total)
+        val_accuracies.append(validation_accuracy)
         print("Validation accuracy for epoch {}: {}".format(epoch + 1, val_accuracies[-1]))
-        validation_accuracy = correct/total
+        print_profile(profiler.end_epoch(epoch + 1))
 
         if validation_accuracy < last_validation_accuracy and trainning_accuracy > last_train_accuracy:
             stopping_condition=True
@@ -194,12 +292,55 @@ if __name__ == "__main__":
 
         epoch += 1
 
-    # Write error examples to a file
+        history = {"train_accuracies": train_accuracies, "val_accuracies": val_accuracies,
+                   "padding_efficiencies": padding_efficiencies, "last_train_accuracy": last_train_accuracy,
+                   "last_validation_accuracy": last_validation_accuracy, "stopping_condition": stopping_condition,
+                   "step_accuracies": step_accuracies}
+        if validation_accuracy > best_validation_accuracy:
+            best_validation_accuracy = validation_accuracy
+            save_checkpoint(best_checkpoint, "rnn", model, model_config, None, optimizer, epoch, history)
+        if args.checkpoint_every > 0 and (epoch % args.checkpoint_every == 0 or stopping_condition):
+            save_checkpoint(last_checkpoint, "rnn", model, model_config, None, optimizer, epoch, history)
+
+    # The stopping epoch has already overfitted: carry on with the best model seen instead
+    if os.path.isfile(best_checkpoint):
+        load_weights(best_checkpoint, model)
+
+    if args.save_model is not None:
+        save_model(args.save_model, "rnn", model, model_config)
+
+    if args.test_data != "to fill":
+        print("========== Scoring {} ==========".format(args.test_data))
+        word2id = {word: index for index, word in enumerate(words)}
+        test_stats = predict(model, partial(convert_to_ids, word2id=word2id), collate_padded,
+                             args.test_data, "results/predictions_rnn.jsonl")
+        print_stats(test_stats)
+
+    profiler.write("results/profile_rnn", vars(args))
+
+    # Write the error samples of the last epoch to a file
+    error_sink.close()
     with open("error-samples/error_samples_rnn.txt", "w") as error_file:
-        for e in error_examples:
-            error_file.write(f"Input: {e['input']}\n")
-            error_file.write(f"Gold Label: {e['gold']}\n")
-            error_file.write(f"Predicted Label: {e['predicted']}\n\n")
+        if "validation" in error_sink.last:
+            record = error_sink.last["validation"]
+            error_file.write("Validation errors of epoch {}: {} of {} documents\n".format(
+                record["epoch"], record["errors"], record["documents"]))
+            error_file.write(format_confusion(record["confusion"]) + "\n")
+            # the ids are lowercased words without punctuation, with 'unk' for the rest: the few sampled
+            # texts are read back from the data file (the one preprocess.py recorded with --data_dir);
+            # without it, or when it has changed since preprocessing, a sample is given by its document index
+            if args.data_dir is not None:
+                val_path, val_digest = split_source(meta, "valid")
+            else:
+                val_path, val_digest = args.val_data, None
+            texts = read_texts(val_path, [sample["index"] for sample in record["samples"]], val_digest)
+            for sample in record["samples"]:
+                if sample["index"] in texts:
+                    error_file.write(f"Input: {texts[sample['index']]}\n")
+                else:
+                    error_file.write(f"Document: {sample['index']}\n")
+                error_file.write(f"Gold Label: {sample['gold']}\n")
+                error_file.write(f"Predicted Label: {sample['predicted']}\n\n")
 
     # Write results to test_rnn.out
     print("========== Writing results to test_rnn.out ==========")
@@ -207,15 +348,26 @@ if __name__ == "__main__":
         f.write("Training Results:\n")
         f.write("Number of epochs: {}\n".format(epoch))
         f.write("Hidden dimension: {}\n".format(args.hidden_dim))
-        f.write("Training data: {}\n".format(args.train_data))
-        f.write("Validation data: {}\n".format(args.val_data))
+        if args.data_dir is not None:
+            f.write("Preprocessed data: {}\n".format(args.data_dir))
+        else:
+            f.write("Training data: {}\n".format(args.train_data))
+            f.write("Validation data: {}\n".format(args.val_data))
         if args.test_data != "to fill":
             f.write("Test data: {}\n".format(args.test_data))
+            write_stats(f, test_stats)
+        if args.eval_subsample is not None:
+            f.write("Validation subsample: {} documents\n".format(args.eval_subsample))
+        if step_accuracies:
+            f.write("\nValidation accuracy every {} steps:\n".format(args.eval_every))
+            for record in step_accuracies:
+                f.write("Epoch {epoch}, step {step}: {accuracy}\n".format(**record))
         f.write("\nEpoch-wise Results:\n")
         for i in range(len(train_accuracies)):
             f.write("\nEpoch {}:\n".format(i + 1))
             f.write("  Training accuracy: {:.4f}\n".format(train_accuracies[i]))
             f.write("  Validation accuracy: {:.4f}\n".format(val_accuracies[i]))
+            f.write("  Padding efficiency: {:.4f}\n".format(padding_efficiencies[i]))
 
         f.write("\nBest Results:\n")
         f.write("Highest validation accuracy: {:.4f}\n".format(max(val_accuracies)))
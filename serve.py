@@ -0,0 +1,106 @@
+import json
+import os
+import string
+import zlib
+from argparse import ArgumentParser
+from itertools import islice
+
+import torch
+
+from data_utils import iter_json_records
+
+
+# Runs a model exported by export.py without the training code: the artifact is a TorchScript module
+# carrying two extra files,
+#   serving.json = {"model": "ffnn" or "rnn", "quantized": bool, "hash_buckets": buckets or null,
+#                   "bigrams": bool}
+#   vocab.txt    = The words of the input ids, one per line (empty with hashed features)
+# and the text is turned into ids here the way ffnn.py / rnn.py do it.
+SERVING_FILE = "serving.json"
+VOCAB_FILE = "vocab.txt"
+
+
+class Predictor:
+    def __init__(self, module, serving, words):
+        self.module = module
+        self.serving = serving
+        self.word2id = {word: index for index, word in enumerate(words)}
+        if serving["model"] == "ffnn" and serving["hash_buckets"] is None:
+            self.unk_id = self.word2id["<UNK>"]
+        elif serving["model"] == "rnn":
+            self.unk_id = self.word2id["unk"]
+
+    # Returns:
+    # ids = The input ids of text (ffnn.convert_to_ids, ffnn.convert_to_hashed_ids or rnn.convert_to_ids)
+    def text_ids(self, text):
+        if self.serving["model"] == "rnn":
+            words = text.translate(text.maketrans("", "", string.punctuation)).split()
+            return [self.word2id.get(word.lower(), self.unk_id) for word in words] or [self.unk_id]
+        words = text.split()
+        buckets = self.serving["hash_buckets"]
+        if buckets is None:
+            return [self.word2id.get(word, self.unk_id) for word in words]
+        ids = [zlib.crc32(word.encode()) % buckets for word in words]
+        if self.serving["bigrams"]:
+            ids.extend(zlib.crc32((first + " " + second).encode()) % buckets for first, second in zip(words, words[1:]))
+        return ids
+
+    # Returns:
+    # inputs = The two tensors the exported module takes for the texts: flat ids and the offset of each
+    #          text (FFNN), or (T, B) padded ids and the length of each text (RNN)
+    def make_inputs(self, texts):
+        documents = [self.text_ids(text) for text in texts]
+        lengths = [len(document) for document in documents]
+        if self.serving["model"] == "ffnn":
+            offsets = [0]
+            for length in lengths[:-1]:
+                offsets.append(offsets[-1] + length)
+            return torch.tensor([i for document in documents for i in document], dtype=torch.long), torch.tensor(offsets)
+        padded = torch.zeros(max(lengths), len(documents), dtype=torch.long)
+        for column, document in enumerate(documents):
+            padded[:len(document), column] = torch.tensor(document)
+        return padded, torch.tensor(lengths)
+
+    # Returns:
+    # probabilities = A (B, 5) tensor with p(1 star), ..., p(5 stars) of each text
+    def predict(self, texts):
+        with torch.inference_mode():
+            return torch.exp(self.module(*self.make_inputs(texts)))
+
+
+# Returns:
+# predictor = The Predictor of the artifact saved at path
+def load_predictor(path):
+    extra_files = {SERVING_FILE: "", VOCAB_FILE: ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    module.eval()
+    words = extra_files[VOCAB_FILE].decode("utf-8").split("\n")[:-1]
+    return Predictor(module, json.loads(extra_files[SERVING_FILE]), words)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--artifact", required = True, help = "model exported by export.py")
+    parser.add_argument("--test_data", required = True, help = "reviews to score (JSON array or JSON lines with \"text\")")
+    parser.add_argument("--output", default = "results/predictions_serving.jsonl", help = "predictions file")
+    parser.add_argument("-b", "--batch_size", type=int, default = 1024, help = "reviews per minibatch")
+    args = parser.parse_args()
+
+    predictor = load_predictor(args.artifact)
+    # the reviews are read one minibatch at a time and each minibatch is written out before the next
+    records = iter_json_records(args.test_data)
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    total = 0
+    with open(args.output, "w") as f:
+        while True:
+            batch = list(islice(records, args.batch_size))
+            if not batch:
+                break
+            probabilities = predictor.predict([record["text"] for record in batch])
+            for offset, row in enumerate(probabilities.tolist()):
+                f.write(json.dumps({"index": total + offset, "stars": row.index(max(row)) + 1,
+                                    "probabilities": [round(p, 6) for p in row]}) + "\n")
+            total += len(batch)
+    print("Scored {} reviews; predictions written to {}".format(total, args.output))
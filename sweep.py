@@ -0,0 +1,185 @@
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from argparse import Namespace, ArgumentParser
+
+import numpy as np
+import torch
+
+from data_utils import DocumentDataset
+from preprocess import preprocess, load_split, load_meta
+from checkpoint import build_model, make_optimizer, make_train_loader, train_epoch
+from evaluate import make_eval_loader, evaluate
+
+
+# A hyperparameter sweep: every combination of hidden_dim, learning rate, optimizer and batch size is a
+# trial, trained for up to --epochs epochs in a pool of worker processes. The data is vectorized once
+# (preprocess.py, unless --data_dir already is such a dataset) and every trial memory-maps the same
+# arrays, so the workers share one read-only copy of it through the page cache.
+#
+# With --prune, a trial stops once its validation accuracy after some epoch (from --prune_after on)
+# falls below the median of what the trials before it reached after that epoch (median pruning).
+#
+# Every trial is one row of results/sweep_<model>.csv and .json, with its accuracy after each epoch,
+# so that the shorter epoch counts are read off the same run.
+COLUMNS = ["trial", "hidden_dim", "lr", "optimizer", "batch_size", "epochs_run", "pruned", "best_epoch",
+           "best_validation_accuracy", "final_validation_accuracy", "train_time", "validation_accuracies"]
+
+
+# The state each pool process keeps: the accuracies reported by all trials (shared) and the
+# memory-mapped splits it has opened
+shared_reports = None
+shared_lock = None
+datasets = {}
+
+
+def init_pool(threads, reports, lock):
+    global shared_reports, shared_lock
+    torch.set_num_threads(threads)
+    shared_reports = reports
+    shared_lock = lock
+
+
+# Returns:
+# dataset = The DocumentDataset of split, memory-mapped once per process
+def open_split(data_dir, split):
+    if (data_dir, split) not in datasets:
+        datasets[data_dir, split] = DocumentDataset(*load_split(data_dir, split))
+    return datasets[data_dir, split]
+
+
+# Records accuracy as a trial's validation accuracy after epoch.
+# Returns:
+# hopeless = Whether it is below the median of the accuracies other trials reported after epoch
+#            (with at least min_trials of them)
+def report(epoch, accuracy, prune, min_trials):
+    with shared_lock:
+        previous = shared_reports.get(epoch, [])
+        shared_reports[epoch] = previous + [accuracy]
+    return prune and len(previous) >= min_trials and accuracy < statistics.median(previous)
+
+
+# Trains one trial (a dict with the swept settings and the run options).
+# Returns:
+# row = The trial's row of the results table (see COLUMNS)
+def run_trial(trial):
+    random.seed(trial["seed"])
+    np.random.seed(trial["seed"])
+    torch.manual_seed(trial["seed"])
+    options = Namespace(model=trial["model"], data_dir=trial["data_dir"], hidden_dim=trial["hidden_dim"],
+                        fine_tune_embedding=False)
+    model, collate_fn, _, _ = build_model(options, load_meta(trial["data_dir"]))
+    optimizer = make_optimizer(trial["model"], model, trial["optimizer"], trial["lr"])
+
+    train_dataset = open_split(trial["data_dir"], "train")
+    valid_dataset = open_split(trial["data_dir"], "valid")
+    train_loader = make_train_loader(trial["model"], train_dataset, collate_fn, trial["batch_size"],
+                                     trial["bucket_width"], trial["seed"])
+    valid_loader = make_eval_loader(valid_dataset, collate_fn)
+
+    validation_accuracies = []
+    pruned = False
+    start_time = time.time()
+    for epoch in range(trial["epochs"]):
+        train_epoch(model, optimizer, train_loader)
+        validation_accuracies.append(evaluate(model, valid_loader))
+        if epoch + 1 >= trial["prune_after"] and report(epoch + 1, validation_accuracies[-1], trial["prune"],
+                                                        trial["prune_min_trials"]):
+            pruned = epoch + 1 < trial["epochs"]
+            break
+
+    best_epoch = int(np.argmax(validation_accuracies)) + 1
+    row = {key: trial[key] for key in ["trial", "hidden_dim", "lr", "optimizer", "batch_size"]}
+    row.update({"epochs_run": len(validation_accuracies), "pruned": pruned, "best_epoch": best_epoch,
+                "best_validation_accuracy": validation_accuracies[best_epoch - 1],
+                "final_validation_accuracy": validation_accuracies[-1], "train_time": time.time() - start_time,
+                "validation_accuracies": validation_accuracies})
+    print("Trial {trial}: hidden_dim {hidden_dim}, lr {lr}, {optimizer}, batch {batch_size}: best validation "
+          "accuracy {best_validation_accuracy:.4f} after epoch {best_epoch}{}".format(
+              " (pruned after epoch {})".format(row["epochs_run"]) if pruned else "", **row))
+    return row
+
+
+def write_table(prefix, args, rows):
+    directory = os.path.dirname(prefix)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(prefix + ".json", "w") as f:
+        json.dump({"args": vars(args), "trials": rows}, f, indent=2)
+    with open(prefix + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, validation_accuracies=" ".join("{:.4f}".format(a) for a in row["validation_accuracies"])))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", choices = ["ffnn", "rnn"], required = True, help = "model to sweep")
+    parser.add_argument("--data_dir", default = None, help = "dataset written by preprocess.py for --model")
+    parser.add_argument("--train_data", default = None, help = "path to training data (without --data_dir)")
+    parser.add_argument("--val_data", default = None, help = "path to validation data (without --data_dir)")
+    parser.add_argument("--embedding", default = "./word_embedding.pkl", help = "RNN: word embedding (without --data_dir)")
+    parser.add_argument("-hd", "--hidden_dim", type=int, nargs="+", required = True, help = "hidden_dim values")
+    parser.add_argument("-e", "--epochs", type=int, required = True,
+                        help = "epochs of each trial; the accuracy after every epoch is kept, so fewer epochs need no trial of their own")
+    parser.add_argument("--lr", type=float, nargs="+", default = [0.01], help = "learning rates")
+    parser.add_argument("--optimizer", nargs="+", choices = ["sgd", "adam"], default = None,
+                        help = "optimizers (default: SGD for the FFNN, Adam for the RNN, as in the training scripts)")
+    parser.add_argument("-b", "--batch_size", type=int, nargs="+", default = [16], help = "minibatch sizes")
+    parser.add_argument("--bucket_width", type=int, default = 10, help = "RNN: length bucket width of the minibatches")
+    parser.add_argument("--processes", type=int, default = 2, help = "trials trained at the same time")
+    parser.add_argument("--threads_per_trial", type=int, default = None,
+                        help = "torch intra-op threads of each trial (default: the cores divided among the processes)")
+    parser.add_argument("--prune", action='store_true', help = "stop trials that fall below the median of the others")
+    parser.add_argument("--prune_after", type=int, default = 2, help = "first epoch after which a trial may be stopped")
+    parser.add_argument("--prune_min_trials", type=int, default = 3,
+                        help = "accuracies other trials must have reported after an epoch before it is used to prune")
+    parser.add_argument("--seed", type=int, default = 42, help = "seed of every trial")
+    args = parser.parse_args()
+    if args.data_dir is None and (args.train_data is None or args.val_data is None):
+        parser.error("either --data_dir or both --train_data and --val_data are required")
+
+    data_dir = args.data_dir
+    if data_dir is None:
+        print("========== Preprocessing data ==========")
+        data_dir = tempfile.mkdtemp(prefix="sweep-")
+        preprocess(args.model, data_dir, {"train": args.train_data, "valid": args.val_data}, args.embedding)
+    elif load_meta(data_dir)["model"] != args.model:
+        parser.error("{} was preprocessed for another model".format(data_dir))
+
+    trials = []
+    for hidden_dim, lr, optimizer, batch_size in itertools.product(
+            args.hidden_dim, args.lr, args.optimizer or [None], args.batch_size):
+        trials.append({"trial": len(trials) + 1, "model": args.model, "data_dir": data_dir, "hidden_dim": hidden_dim,
+                       "lr": lr, "optimizer": optimizer or ("sgd" if args.model == "ffnn" else "adam"),
+                       "batch_size": batch_size, "bucket_width": args.bucket_width, "epochs": args.epochs,
+                       "prune": args.prune, "prune_after": args.prune_after,
+                       "prune_min_trials": args.prune_min_trials, "seed": args.seed})
+
+    threads = args.threads_per_trial or max(1, (os.cpu_count() or 1) // args.processes)
+    print("========== Running {} trials in {} processes of {} threads ==========".format(
+        len(trials), args.processes, threads))
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        initargs = (threads, manager.dict(), manager.Lock())
+        with context.Pool(args.processes, initializer=init_pool, initargs=initargs) as pool:
+            rows = pool.map(run_trial, trials, chunksize=1)
+    if args.data_dir is None:
+        shutil.rmtree(data_dir)
+
+    prefix = os.path.join("results", "sweep_" + args.model)
+    write_table(prefix, args, rows)
+    print("========== Trials by best validation accuracy ==========")
+    for row in sorted(rows, key=lambda row: -row["best_validation_accuracy"]):
+        print("{trial:>4}  hidden_dim {hidden_dim:<5} lr {lr:<8} {optimizer:<5} batch {batch_size:<5} "
+              "{best_validation_accuracy:.4f} (epoch {best_epoch}/{epochs_run}){}".format(
+                  "  pruned" if row["pruned"] else "", **row))
+    print("Results written to {}.csv and {}.json".format(prefix, prefix))